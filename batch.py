@@ -0,0 +1,174 @@
+import json
+import random
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from rich import print
+
+from metrics import percentile
+
+
+def read_prompts(source, system_message=None):
+    """yield (index, id, messages or error) from jsonl file, or stdin for "-"
+
+    Line is a json string (prompt), or object with "prompt" or "messages" key and optional "id".
+    Lines are read one by one, so input of any size can be piped in.
+    """
+    f = sys.stdin if source == '-' else open(source, encoding='utf-8')
+    try:
+        for index, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as err:
+                yield index, index, f'JSONDecodeError: {err}'
+                continue
+            if isinstance(item, str):
+                item = {'prompt': item}
+            if not isinstance(item, dict) or not ('prompt' in item or 'messages' in item):
+                yield index, index, 'ValueError: expected string, or object with "prompt" or "messages"'
+                continue
+            messages = item.get('messages')
+            if messages is None:
+                messages = [system_message] if system_message else []
+                messages.append({"role": "user", "content": str(item['prompt'])})
+            yield index, item.get('id', index), messages
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def read_done(output):
+    """ids of prompts already answered, from jsonl output"""
+    done = set()
+    if not output.exists():
+        return done
+    with open(output, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # last line may be broken by interrupted run
+                continue
+            if 'answer' in record:
+                done.add(json.dumps(record['id']))
+    return done
+
+
+def is_retryable(err):
+    """rate limits, server errors and broken connections are worth retrying"""
+    import httpx  # used by both openai and ollama
+    status = getattr(err, 'status_code', None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    if isinstance(err, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    try:
+        from openai import APIConnectionError
+    except ModuleNotFoundError:
+        return False
+    return isinstance(err, APIConnectionError)
+
+
+def answer_prompt(client, index, prompt_id, messages, retries, use_cache):
+    """ask for single prompt with exponential backoff, return jsonl record"""
+    record = {'id': prompt_id, 'index': index}
+    start = time.perf_counter()
+    if isinstance(messages, str):
+        record['error'] = messages
+        return record
+    for attempt in range(retries+1):
+        try:
+            record['answer'] = client.complete(messages, use_cache)
+            break
+        except Exception as err:
+            if attempt == retries or not is_retryable(err):
+                record['error'] = f'{type(err).__name__}: {err}'
+                break
+            time.sleep(min(2 ** attempt, 60) + random.random())
+    record['attempts'] = attempt + 1
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def run_batch(client, source, output, workers=4, retries=5, ordered=True, use_cache=True):
+    """answer prompts using pool of workers, append results to jsonl output, skip those already answered
+
+    With ordered=True results are written in input order, so slow request holds back later ones,
+    otherwise as soon as they complete. Number of prompts read ahead is bounded in both cases.
+    """
+    output = Path(output)
+    done = read_done(output)
+    if done:
+        print(f'[*] already answered: {len(done)}', file=sys.stderr)
+    if output.exists() and output.stat().st_size:
+        # make sure broken record from interrupted run doesn't swallow the next one
+        with open(output, 'rb+') as f:
+            f.seek(-1, 2)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+    prompts = (item for item in read_prompts(source, client.system_message) if json.dumps(item[1]) not in done)
+    limit = workers * 4  # requests in flight plus results waiting for their turn
+    pending = set()
+    finished = {}  # position -> record, waiting to be written in order
+    position = 0  # position of next submitted prompt
+    written = 0  # position of next record to write
+    answered = failed = 0
+    latencies = []
+    start = time.perf_counter()
+
+    def write(record):
+        nonlocal answered, failed
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        f.flush()
+        answered += 'answer' in record
+        failed += 'error' in record
+        if 'seconds' in record:
+            latencies.append(record['seconds'])
+        total = answered + failed
+        if not total % 10 or 'error' in record:
+            rate = total / (time.perf_counter() - start)
+            status = f"[red]failed: {record['id']}, {record['error']}[/red]" if 'error' in record else 'ok'
+            print(f'[*] {total}) {status} ({rate:.2f} prompts/s)', file=sys.stderr)
+
+    with open(output, 'a', encoding='utf-8') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) + len(finished) < limit:
+                    item = next(prompts, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    future = executor.submit(answer_prompt, client, *item, retries, use_cache)
+                    future.position = position
+                    pending.add(future)
+                    position += 1
+                if not pending:
+                    break
+                completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    if ordered:
+                        finished[future.position] = future.result()
+                    else:
+                        write(future.result())
+                while written in finished:
+                    write(finished.pop(written))
+                    written += 1
+        except KeyboardInterrupt:
+            print('\n[*] broken by user, run again to resume', file=sys.stderr)
+            executor.shutdown(wait=False, cancel_futures=True)
+            return
+    elapsed = time.perf_counter() - start
+    total = answered + failed
+    print(f'[*] prompts: {total} in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.2f} prompts/s), failed: {failed}', file=sys.stderr)
+    if latencies:
+        latencies.sort()
+        print(f'[*] latency p50/p95: {percentile(latencies, 50):.2f}s / {percentile(latencies, 95):.2f}s', file=sys.stderr)
+    if client.metrics is not None:
+        totals = client.metrics.totals
+        print(f"[*] tokens: prompt={totals['prompt_tokens']} (cached={totals['cached_tokens']}) completion={totals['completion_tokens']} ({totals['completion_tokens'] / elapsed if elapsed else 0:.1f} completion tok/s)", file=sys.stderr)
+    print(f'[*] results saved to: {output}', file=sys.stderr)
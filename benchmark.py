@@ -0,0 +1,460 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from rich import print
+
+from chat import RENDER_CACHE, Block, BlockParser, GPTClient, OllamaClient, pretty_print_answer, prerender_talk_page, show_talk_page, split_codeblocks
+from mock_server import MockConfig, make_png, start_server
+from store import ConversationStore
+
+
+def split_codeblocks_legacy(text):
+    """Previous, non-incremental version of split_codeblocks (kept for comparison)"""
+    lines = iter(text.splitlines())
+    blocks = []
+    rows = []
+    skip = False
+    while True:
+        if not skip:
+            line = next(lines, None)
+            if line is None:
+                break
+        if line.startswith("```"):
+            skip = False
+            block_type = line.removeprefix("```").strip()
+            while True:
+                line = next(lines, None)
+                if (line is None) or (line.startswith("```")):
+                    if rows:
+                        block = Block(content="\n".join(rows), type=block_type)
+                        blocks.append(block)
+                        rows = []
+                    break
+                else:
+                    rows.append(line)
+        else:
+            block_type = 'text'
+            rows.append(line)
+            while True:
+                line = next(lines, None)
+                if (line is not None) and line.startswith("```"):
+                    # to change state, to go code section
+                    skip = True
+                if (line is None) or (line.startswith("```")):
+                    if rows:
+                        block = Block(content="\n".join(rows), type=block_type)
+                        blocks.append(block)
+                        rows = []
+                    break
+                else:
+                    rows.append(line)
+    return blocks
+
+
+def random_answer(size, seed=0):
+    """generate markdown answer of specified size (in bytes), mixing text and code blocks"""
+    rng = random.Random(seed)
+    words = ['the', 'function', 'returns', 'value', 'list', '`x`', 'and', 'loop', 'with', 'index']
+    code = ['for i in range(10):', '    print(i)', 'x = [1, 2, 3]', 'def f(a, b):', '    return a + b']
+    parts = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.3:
+            rows = [rng.choice(code) for _ in range(rng.randint(3, 30))]
+            part = '```python\n' + '\n'.join(rows) + '\n```\n'
+        else:
+            part = ' '.join(rng.choice(words) for _ in range(rng.randint(5, 80))) + '\n'
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+
+def token_chunks(text, seed=0):
+    """split text into small, token-like chunks"""
+    rng = random.Random(seed)
+    chunks = []
+    index = 0
+    while index < len(text):
+        step = rng.randint(1, 8)
+        chunks.append(text[index:index+step])
+        index += step
+    return chunks
+
+
+def measure(func, *args, repeat=3):
+    """best time of few runs"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def feed_chunks(chunks, stream_text=False):
+    parser = BlockParser(stream_text=stream_text)
+    blocks = []
+    for chunk in chunks:
+        blocks.extend(parser.feed(chunk))
+    blocks.extend(parser.close())
+    return blocks
+
+
+def bench_codeblocks(size_mb):
+    """compare split_codeblocks implementations throughput"""
+    text = random_answer(int(size_mb * 1024 * 1024))
+    chunks = token_chunks(text)
+    megabytes = len(text) / 1024 / 1024
+    print(f'[*] codeblocks: {megabytes:.2f}MB answer, {len(chunks)} chunks')
+    cases = [
+        ('legacy split_codeblocks', split_codeblocks_legacy, (text,)),
+        ('split_codeblocks', split_codeblocks, (text,)),
+        ('BlockParser chunked', feed_chunks, (chunks,)),
+        ('BlockParser chunked, stream_text', feed_chunks, (chunks, True)),
+    ]
+    expected = None
+    results = {}
+    for name, func, args in cases:
+        elapsed, blocks = measure(func, *args)
+        if expected is None:
+            expected = blocks
+        elif len(args) == 1 or args[-1] is not True:
+            assert blocks == expected, f'{name} result differs'
+        print(f'    {name:<36} {elapsed*1000:8.1f}ms {megabytes/elapsed:8.1f}MB/s')
+        results[f'codeblocks/{name} MB/s'] = megabytes / elapsed
+    return results
+
+
+def render_cold(text):
+    RENDER_CACHE.clear()
+    pretty_print_answer(text)
+
+
+def bench_render(sizes=(1, 16, 256)):
+    """pretty_print_answer throughput, output goes to memory"""
+    print('[*] render:')
+    results = {}
+    for size in sizes:
+        text = random_answer(size * 1024)
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, _ = measure(render_cold, text)
+            cached, _ = measure(pretty_print_answer, text)
+        print(f'    {size:>5}KB answer {elapsed*1000:10.1f}ms {size / 1024 / elapsed:8.2f}MB/s, cached {cached*1000:8.2f}ms')
+        results[f'render/{size}KB ms'] = elapsed * 1000
+        results[f'render/{size}KB cached ms'] = cached * 1000
+    return results
+
+
+def bench_talk(turns=500, page_size=5):
+    """talk command: whole conversation printed at once against single page, cold and cached"""
+    print(f'[*] talk ({turns} turns):')
+    messages = [{"role": "system", "content": "rule: reply directly"}]
+    for index in range(turns):
+        messages.append({"role": "user", "content": f'question {index}'})
+        messages.append({"role": "assistant", "content": random_answer(2048, seed=index)})
+    starts = list(range(1, len(messages), 2))
+    last = (turns - 1) // page_size
+    with contextlib.redirect_stdout(io.StringIO()):
+        whole, _ = measure(print, messages, repeat=1)
+        RENDER_CACHE.clear()
+        cold, _ = measure(show_talk_page, messages, starts, last, page_size, repeat=1)
+        cached, _ = measure(show_talk_page, messages, starts, last, page_size)
+        back = 0
+        for page in range(last, -1, -1):
+            start = time.perf_counter()
+            show_talk_page(messages, starts, page, page_size)
+            back += (time.perf_counter() - start) / (last + 1)
+            if page:
+                # done in background by show_talk, while page is read
+                prerender_talk_page(messages, starts, page - 1, page_size)
+    print(f'    whole list printed {whole*1000:10.1f}ms')
+    print(f'    page, cold         {cold*1000:10.1f}ms')
+    print(f'    page, cached       {cached*1000:10.1f}ms')
+    print(f'    paging back, avg   {back*1000:10.1f}ms/page (older page prerendered)')
+    return {
+        'talk/whole ms': whole * 1000,
+        'talk/page cold ms': cold * 1000,
+        'talk/page cached ms': cached * 1000,
+        'talk/paging back ms': back * 1000,
+    }
+
+
+def import_times(module):
+    """total import time of module and times of modules it imports directly (ms), from python -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, name.strip(), int(cumulative) / 1000))
+    # children are listed before their parent
+    index = max(index for index, (depth, name, _) in enumerate(entries) if depth == 0 and name == module)
+    total = entries[index][2]
+    times = {}
+    for depth, name, elapsed in reversed(entries[:index]):
+        if depth == 0:
+            break
+        elif depth == 1:
+            times[name] = elapsed
+    return total, times
+
+
+def time_to_prompt(script, prompt=b'[*] you:', answer=b'exit\n'):
+    """seconds from process start to the first prompt of interactive script"""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, script],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    output = b''
+    while prompt not in output:
+        data = os.read(process.stdout.fileno(), 1024)
+        if not data:
+            raise Exception(f'{script} exited before prompt')
+        output += data
+    elapsed = time.perf_counter() - start
+    process.communicate(answer)
+    return elapsed
+
+
+def time_to_exit(*command):
+    """seconds needed to run short command, like --help"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *command], capture_output=True)
+    return time.perf_counter() - start
+
+
+def bench_startup(repeat, limit=None):
+    """import time breakdown and time to prompt of scripts"""
+    for module in ('chat', 'ocr', 'imager'):
+        total, times = import_times(module)
+        print(f'[*] import {module}: {total:.1f}ms')
+        for name, elapsed in sorted(times.items(), key=lambda item: item[1], reverse=True)[:5]:
+            print(f'    {name:<24} {elapsed:8.1f}ms')
+    results = {
+        'chat.py time to prompt': [time_to_prompt('chat.py') for _ in range(repeat)],
+        'ocr.py --help': [time_to_exit('ocr.py', '--help') for _ in range(repeat)],
+        'imager.py --help': [time_to_exit('imager.py', '--help') for _ in range(repeat)],
+    }
+    print(f'[*] startup (median of {repeat}):')
+    for name, times in results.items():
+        print(f'    {name:<24} {statistics.median(times)*1000:8.1f}ms')
+    median = statistics.median(results['chat.py time to prompt']) * 1000
+    if limit and median > limit:
+        print(f'[red][x] chat.py time to prompt {median:.1f}ms exceeds limit {limit}ms[/red]')
+        sys.exit(1)
+    return {f'startup/{name} ms': statistics.median(times) * 1000 for name, times in results.items()}
+
+
+def conversation(turns, size=400):
+    """history of specified number of turns"""
+    messages = [{"role": "system", "content": "rule: reply directly"}]
+    for index in range(turns):
+        messages.append({"role": "user", "content": f'question {index} ' + 'x' * size})
+        messages.append({"role": "assistant", "content": f'answer {index} ' + 'y' * size})
+    return messages
+
+
+def bench_turns(lengths=(0, 10, 100, 500), repeat=3):
+    """end-to-end turn latency against conversation length, for both clients"""
+    print('[*] turns (median):')
+    results = {}
+    directory = tempfile.mkdtemp()
+    for backend, client_class, model in (('openai', GPTClient, 'mock-gpt'), ('ollama', OllamaClient, 'mock-llama')):
+        try:
+            client = client_class(model, system_message=None, store=ConversationStore(directory), budget=10**9)
+        except ModuleNotFoundError as err:
+            print(f'    {backend}: skipped, {err}')
+            continue
+        for length in lengths:
+            totals = []
+            ttfts = []
+            for _ in range(repeat):
+                client.messages = conversation(length)
+                start = time.perf_counter()
+                stream = client.ask_stream('question')
+                next(stream)
+                ttfts.append(time.perf_counter() - start)
+                for _ in stream:
+                    pass
+                totals.append(time.perf_counter() - start)
+            ttft, total = statistics.median(ttfts), statistics.median(totals)
+            print(f'    {backend:<8} {length:>5} turns  ttft {ttft*1000:8.1f}ms  total {total*1000:8.1f}ms')
+            results[f'turns/{backend} {length} turns ttft ms'] = ttft * 1000
+            results[f'turns/{backend} {length} turns total ms'] = total * 1000
+        if backend == 'ollama':
+            # models command reads replies of list and ps, shaped differently by ollama-python versions
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                client.get_models()
+            elapsed = time.perf_counter() - start
+            print(f'    {backend:<8} models command     {elapsed*1000:8.1f}ms')
+            results[f'turns/{backend} models ms'] = elapsed * 1000
+        client.save_conversation()
+    return results
+
+
+def write_json_legacy(filename, data):
+    """previous way of saving conversation, whole history rewritten every time"""
+    with open(filename, 'w', encoding='utf-8') as fp:
+        json.dump(data, fp, sort_keys=True, indent=4, ensure_ascii=False)
+
+
+def bench_store(lengths=(10, 100, 1000, 5000)):
+    """cost of saving a turn and loading conversation, against history size"""
+    print('[*] store:')
+    results = {}
+    store = ConversationStore(tempfile.mkdtemp())
+    for length in lengths:
+        messages = conversation(length)
+        path = store.path(f'bench{length}', 'mock')
+        store.append(path, {'meta': {'id': f'bench{length}'}})
+        for message in messages:
+            store.append(path, message)
+        append, _ = measure(store.append, path, {"role": "user", "content": "next question"})
+        load, _ = measure(store.read, path)
+        rewrite, _ = measure(write_json_legacy, store.directory / f'bench{length}.json', messages)
+        store.close(path)
+        print(f'    {length:>5} turns  append {append*1000:7.2f}ms  legacy rewrite {rewrite*1000:8.2f}ms  load {load*1000:8.2f}ms')
+        results[f'store/{length} turns append ms'] = append * 1000
+        results[f'store/{length} turns legacy rewrite ms'] = rewrite * 1000
+        results[f'store/{length} turns load ms'] = load * 1000
+    return results
+
+
+def bench_ocr(url, workers=(1, 4, 8), images=16):
+    """batch ocr throughput against number of workers"""
+    import ocr
+    from openai import OpenAI
+    print(f'[*] ocr ({images} images):')
+    results = {}
+    directory = Path(tempfile.mkdtemp())
+    for index in range(images):
+        (directory / f'scan{index}.png').write_bytes(make_png(64 + index, 64))
+    paths = ocr.find_images(str(directory))
+    client = OpenAI(base_url=f'{url}/v1', api_key='mock', max_retries=0)
+    for count in workers:
+        output = directory / f'ocr-{count}.jsonl'
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ocr.run_batch(client, paths, output, workers=count)
+        rate = images / (time.perf_counter() - start)
+        print(f'    {count:>2} workers {rate:8.2f} img/s')
+        results[f'ocr/{count} workers img/s'] = rate
+    return results
+
+
+def bench_images(url, concurrency=(1, 4, 8), number=8):
+    """image generation and saving throughput against concurrency"""
+    import imager
+    from openai import OpenAI
+    print(f'[*] images ({number} images):')
+    results = {}
+    directory = Path(tempfile.mkdtemp())
+    client = OpenAI(base_url=f'{url}/v1', api_key='mock', max_retries=0)
+    for response_format in ('b64_json', 'url'):
+        for count in concurrency:
+            session = imager.create_session(count)
+            query = dict(model='dall-e-3', prompt='benchmark', size='1024x1024', response_format=response_format)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=count) as executor:
+                futures = [
+                    executor.submit(
+                        imager.generate_and_save, index, client, session, imager.RateLimiter(0),
+                        threading.Event(), directory, response_format, len(str(number)), **query
+                    )
+                    for index in range(1, number+1)
+                ]
+                assert all(future.result() for future in futures)
+            rate = number / (time.perf_counter() - start)
+            print(f'    {response_format:<8} concurrency {count:>2} {rate:8.2f} img/s')
+            results[f'images/{response_format} concurrency {count} img/s'] = rate
+    return results
+
+
+def bench_suite(config, only=None):
+    """run benchmarks against local mock server, save results to benchmarks/"""
+    server, url = start_server(config=config)
+    os.environ.update({'OPENAI_BASE_URL': f'{url}/v1', 'OPENAI_API_KEY': 'mock', 'OLLAMA_HOST': url})
+    benchmarks = {
+        'codeblocks': lambda: bench_codeblocks(2),
+        'render': bench_render,
+        'talk': bench_talk,
+        'startup': lambda: bench_startup(3),
+        'turns': bench_turns,
+        'store': bench_store,
+        'ocr': lambda: bench_ocr(url),
+        'images': lambda: bench_images(url),
+    }
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if only and name not in only:
+            continue
+        results.update(benchmark())
+    server.shutdown()
+    directory = Path('benchmarks')
+    directory.mkdir(exist_ok=True)
+    path = directory / f'{time.strftime("%Y%m%d%H%M%S")}.json'
+    mock = {key: value for key, value in vars(config).items() if key != 'requests'}
+    path.write_text(json.dumps({'time': time.time(), 'mock': mock, 'results': results}, indent=4))
+    print(f'[*] results saved to: [cyan]{path}[/cyan]')
+
+
+def compare(paths):
+    """compare results of two runs, by default two latest ones"""
+    if not paths:
+        paths = sorted(Path('benchmarks').glob('*.json'))[-2:]
+    if len(paths) != 2:
+        print('[red][x] two benchmark results needed[/red]')
+        return
+    before, after = [json.loads(Path(path).read_text())['results'] for path in paths]
+    print(f'[*] {paths[0]} -> {paths[1]}')
+    for name in before.keys() & after.keys():
+        old, new = before[name], after[name]
+        change = (new - old) / old * 100 if old else 0
+        print(f'    {name:<56} {old:10.2f} {new:10.2f} {change:+7.1f}%')
+
+
+if __name__ == "__main__":
+    os.chdir(str(Path(__file__).parent))
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    codeblocks_parser = subparsers.add_parser("codeblocks", help="split_codeblocks/BlockParser throughput")
+    codeblocks_parser.add_argument("--size", default=4, type=float, help="Size of generated answer in MB")
+    startup_parser = subparsers.add_parser("startup", help="Import times and time to prompt")
+    startup_parser.add_argument("--repeat", default=5, type=int, help="Number of runs")
+    startup_parser.add_argument("--limit", default=None, type=float, help="Fail if chat.py time to prompt exceeds it (ms)")
+    suite_parser = subparsers.add_parser("suite", help="All benchmarks against local mock server, results saved to benchmarks/")
+    suite_parser.add_argument("--only", nargs='+', choices=["codeblocks", "render", "talk", "startup", "turns", "store", "ocr", "images"])
+    suite_parser.add_argument("--latency", default=0.05, type=float, help="Mock server seconds before first token")
+    suite_parser.add_argument("--token-rate", default=0, type=float, help="Mock server tokens per second (0 for no delay)")
+    suite_parser.add_argument("--answer-tokens", default=60, type=int, help="Mock server tokens in every answer")
+    suite_parser.add_argument("--image-latency", default=0.2, type=float, help="Mock server seconds to generate image")
+    compare_parser = subparsers.add_parser("compare", help="Compare two saved results (two latest by default)")
+    compare_parser.add_argument("paths", nargs='*')
+    args = parser.parse_args()
+    if args.benchmark == 'codeblocks':
+        bench_codeblocks(args.size)
+    elif args.benchmark == 'startup':
+        bench_startup(args.repeat, args.limit)
+    elif args.benchmark == 'suite':
+        config = MockConfig(latency=args.latency, token_rate=args.token_rate, answer_tokens=args.answer_tokens, image_latency=args.image_latency)
+        bench_suite(config, args.only)
+    elif args.benchmark == 'compare':
+        compare(args.paths)
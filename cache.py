@@ -0,0 +1,124 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class ResponseCache:
+    """On-disk cache of answers, with LRU eviction bounded by number of entries and age.
+
+    Recently used entries are also kept in memory, so hits don't touch the disk at all.
+    Access times of hits are written lazily, together with next insert or on close.
+    """
+    def __init__(self, path=Path('cache') / 'responses.sqlite', max_entries=5000, max_age=30*24*3600, memory_entries=256):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()  # key -> (answer, created)
+        self.touched = {}  # key -> accessed, not yet written to disk
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, answer TEXT, created REAL, accessed REAL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.db.commit()
+
+    @staticmethod
+    def make_key(backend, model, temperature, messages):
+        """hash of everything that affects the answer"""
+        data = json.dumps([backend, model, temperature, messages], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """cached answer or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None:
+                row = self.db.execute('SELECT answer, created FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    entry = tuple(row)
+                    self._remember(key, entry)
+            else:
+                self.memory.move_to_end(key)
+            if (entry is None) or (now - entry[1] > self.max_age):
+                self.misses += 1
+                return None
+            self.touched[key] = now
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, answer):
+        now = time.time()
+        with self.lock:
+            self._remember(key, (answer, now))
+            self.touched.pop(key, None)
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, answer, now, now))
+            self._flush()
+            self._evict(now)
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.touched.clear()
+            self.db.execute('DELETE FROM responses')
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.commit()
+            self.db.close()
+
+    def stats(self):
+        """hits, misses and size of cache"""
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0,
+            'entries': entries,
+            'bytes': self.path.stat().st_size,
+        }
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _flush(self):
+        """write access times of hits"""
+        if self.touched:
+            self.db.executemany(
+                'UPDATE responses SET accessed = ? WHERE key = ?',
+                [(accessed, key) for key, accessed in self.touched.items()]
+            )
+            self.touched.clear()
+
+    def _evict(self, now):
+        """drop expired entries and least recently used ones above the limit"""
+        rows = self.db.execute(
+            'SELECT key FROM responses WHERE created < ? UNION '
+            'SELECT key FROM (SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+            (now - self.max_age, self.max_entries)
+        ).fetchall()
+        if not rows:
+            return
+        self.db.executemany('DELETE FROM responses WHERE key = ?', rows)
+        for (key,) in rows:
+            self.memory.pop(key, None)
@@ -1,28 +1,32 @@
-import json
+import hashlib
 import os
+import queue
+import sys
+import threading
 import time
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from pathlib import Path
 
-try:
-    import ollama
-except ModuleNotFoundError as err:
-    # print(err)
-    # print('you have to install ollama (`pip install ollama`), as well as model that you specify')
-    pass
 try:
     # to support linux terminal
     import readline
 except:
     pass
-from dotenv import dotenv_values
-from openai import OpenAI
-from rich import print
-from rich.columns import Columns
-from rich.panel import Panel
-from rich.syntax import Syntax
+from rich import get_console, print
+
+# openai, ollama and rich renderables are slow to import, so they are imported on first use
+from cache import ResponseCache
+from metrics import ConversationUsage, Metrics, ollama_usage, openai_usage
+from store import ConversationStore
+from tokens import OPENAI_CONTEXT_LENGTH, ContextWindow, context_length, summary_request
 
 Block = namedtuple("Block", ["content", "type"])
+# commands which don't change conversation, available while session waits for answer in background
+READONLY_COMMANDS = ('stream', 'tokens', 'stats', 'cache', 'cache clear', 'talk', 'id', 'help', 'models', 'model')
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "rule: reply directly without long summaries and comments, in few words"
+}
 
 
 class Color:
@@ -35,36 +39,199 @@ class Color:
 
 
 class OllamaClient:
-    def __init__(self, model, system_message=None, context=True):
+    __backend = 'ollama'
+
+    def __init__(self, model, system_message=None, context=True, stream=True, cache=None, store=None, budget=None, summarize=False, metrics=None, keep_alive='30m', num_ctx=8192):
         self.model = model
+        self.keep_alive = keep_alive  # how long model stays loaded after last request, ollama default is 5m
+        self.max_num_ctx = num_ctx  # bigger context takes more memory, ollama default is 2048
         self.system_message = system_message
         self.messages = [self.system_message]
         self.context = context
+        self.stream = stream
+        self.cache = cache
+        self.store = store or ConversationStore()
+        self.window = ContextWindow(model, budget, summarize, length=self.num_ctx)
+        self.metrics = metrics
+        self.token_usage = ConversationUsage()  # of current conversation, saved with it
+        self.retrieval = None  # Retriever, when only relevant earlier turns are sent
         self.conversation_id = self.__now()
+        self.conversation_path = None
 
-    def ask(self, content):
+    @property
+    def num_ctx(self):
+        """context length sent with every request, window is trimmed to it"""
+        return min(self.max_num_ctx, context_length(self.model))
+
+    def ask(self, content, use_cache=True):
         user_message = {"role": "user", "content": content}
         if self.context:
             self.messages.append(user_message)
         else:
             self.messages = [self.system_message, user_message]
-        response = ollama.chat(model=self.model, messages=self.messages)
-        reply = response['message']
+        self.__persist(user_message)
+        try:
+            answer = run_cancellable(self.complete, self.__window(), use_cache)
+            reply = {"role": "assistant", "content": answer}
+        except KeyboardInterrupt:
+            # whole answer comes at once, so there is nothing to keep but the mark
+            answer = ''
+            reply = {"role": "assistant", "content": answer, "truncated": True}
 
         # keep conversation anyway
         self.messages.append(reply)
+        self.__persist(reply)
+        return answer
 
-        answer = reply['content']
+    def complete(self, messages, use_cache=True):
+        """answer to messages, conversation is not changed, so it can be called from many threads"""
+        key = self.__cache_key(messages, use_cache)
+        turn = self.metrics.start(self.model, self.__backend, messages) if self.metrics else None
+        answer = self.cache.get(key) if key else None
+        if answer is not None:
+            if turn:
+                self.metrics.record(turn.finish(cache_hit=True))
+            return answer
+        import ollama  # you have to install ollama (`pip install ollama`), as well as model that you specify
+        response = ollama.chat(model=self.model, messages=messages, keep_alive=self.keep_alive, options={'num_ctx': self.num_ctx})
+        usage = ollama_usage(response)
+        if turn:
+            self.metrics.record(turn.finish(**usage))
+        self.token_usage.add(usage, turn.data['ttft'] if turn else None)
+        answer = response['message']['content']
+        if key:
+            self.cache.put(key, answer)
         return answer
 
+    def ask_stream(self, content, use_cache=True, cancelled=None):
+        """ask model and yield answer chunks as they arrive
+
+        Setting cancelled (threading.Event) from another thread ends the answer as truncated,
+        also before its first chunk.
+        """
+        user_message = {"role": "user", "content": content}
+        if self.context:
+            self.messages.append(user_message)
+        else:
+            self.messages = [self.system_message, user_message]
+        self.__persist(user_message)
+        messages = self.__window()
+        key = self.__cache_key(messages, use_cache)
+        turn = self.metrics.start(self.model, self.__backend, messages) if self.metrics else None
+        answer = self.cache.get(key) if key else None
+        if answer is not None:
+            reply = {"role": "assistant", "content": answer}
+            self.messages.append(reply)
+            self.__persist(reply)
+            if turn:
+                self.metrics.record(turn.finish(cache_hit=True))
+            yield answer
+            return
+        import ollama
+        generation = Generation(lambda: ollama.chat(model=self.model, messages=messages, stream=True, keep_alive=self.keep_alive, options={'num_ctx': self.num_ctx}), cancelled)
+        chunks = []
+        usage = {}
+        truncated = True
+        try:
+            for chunk in generation:
+                if chunk.get('done'):
+                    usage = ollama_usage(chunk)
+                token = chunk['message']['content']
+                if not token:
+                    continue
+                if turn:
+                    turn.token()
+                chunks.append(token)
+                yield token
+            truncated = generation.cancelled.is_set()
+        except KeyboardInterrupt:
+            # stop generation, keep what was answered so far
+            pass
+        finally:
+            self.__finish_stream(generation, chunks, truncated, turn, usage, key)
+
+    def __finish_stream(self, generation, chunks, truncated, turn, usage, key):
+        """keep streamed answer, also when it was interrupted (by Ctrl+C or closed generator)"""
+        generation.cancel()
+        if turn:
+            self.metrics.record(turn.finish(truncated=truncated, **usage))
+        if usage:
+            self.token_usage.add(usage, turn.data['ttft'] if turn else None)
+        reply = {"role": "assistant", "content": "".join(chunks)}
+        if truncated:
+            reply['truncated'] = True
+        # keep conversation anyway
+        self.messages.append(reply)
+        self.__persist(reply)
+        if key and not truncated:
+            self.cache.put(key, reply['content'])
+
+    def __cache_key(self, messages, use_cache):
+        """key of current request in responses cache, None if cache is not used"""
+        if (self.cache is None) or not use_cache:
+            return None
+        return ResponseCache.make_key(self.__backend, self.model, None, messages)
+
+    def __window(self):
+        """messages to send, trimmed to model's token budget"""
+        if not self.context:
+            return request_messages(self.messages)
+        if self.retrieval is not None:
+            # history changes with every question, so there is nothing to summarize
+            messages = self.retrieval.select(self.messages, self.conversation_path.name)
+            if messages is not None:
+                # retrieved turns change with every question, so there is no stable prefix to keep
+                return request_messages(self.window.select(messages, stable=False))
+        return request_messages(self.window.select(self.messages, self.__summarize))
+
+    def __summarize(self, summary, messages):
+        import ollama
+        response = ollama.chat(model=self.model, messages=summary_request(summary, messages), keep_alive=self.keep_alive, options={'num_ctx': self.num_ctx})
+        return response['message']['content']
+
+    def warm_up(self):
+        """load model in background, so first question doesn't wait for it"""
+        def load():
+            import ollama
+            try:
+                # request without prompt only loads the model, with the same num_ctx, or it's loaded again
+                ollama.generate(model=self.model, keep_alive=self.keep_alive, options={'num_ctx': self.num_ctx})
+            except Exception as err:
+                print(f'[red]\[x] failed to load {self.model}: {type(err).__name__}: {err}[/red]')
+        threading.Thread(target=load, daemon=True).start()
+
     def get_models(self):
-        """show information about locally available models"""
-        print(ollama.list())
+        """show locally available models, and memory used by loaded ones"""
+        import ollama
+        from rich.table import Table
+        # 'model' key is in replies of every ollama-python version, 'name' is gone since 0.4
+        loaded = {model['model']: model for model in ollama.ps()['models']}
+        table = Table(title='models')
+        for header in ('name', 'size', 'loaded', 'vram', 'unloads at'):
+            table.add_column(header, justify='left' if header in ('name', 'unloads at') else 'right')
+        for model in ollama.list()['models']:
+            running = loaded.get(model['model'])
+            name = f"[cyan]{model['model']}[/cyan]" if model['model'].split(':')[0] == self.model.split(':')[0] else model['model']
+            if running is None:
+                table.add_row(name, f"{model['size'] / 2**30:.1f}GB", '-', '-', '-')
+                continue
+            expires = str(running.get('expires_at', '-'))[:19].replace('T', ' ')
+            table.add_row(name, f"{model['size'] / 2**30:.1f}GB", f"{running['size'] / 2**30:.1f}GB", f"{running.get('size_vram', 0) / 2**30:.1f}GB", expires)
+        print(table)
 
     def get_model(self):
         """show information about currently used model"""
         print(f'[*] current model: {self.model}')
 
+    def switch_model(self, model):
+        """continue with another model, in new conversation"""
+        self.save_conversation()
+        self.model = model
+        self.messages = [self.system_message]
+        self.window = ContextWindow(model, summarize=self.window.summarize, length=self.num_ctx)
+        self.warm_up()
+        print(f'[*] model set to: {self.model}')
+
     def switch_context(self):
         self.context = not self.context
         if not self.context:
@@ -72,92 +239,317 @@ class OllamaClient:
             self.messages = [self.system_message]
         print(f'[*] context set to: {self.context}')
 
+    def switch_stream(self):
+        self.stream = not self.stream
+        print(f'[*] stream set to: {self.stream}')
+
+    def switch_retrieval(self):
+        """send only relevant earlier turns and recent messages, instead of whole history"""
+        if self.retrieval is not None:
+            self.retrieval.close()
+            self.retrieval = None
+        else:
+            try:
+                from retrieval import Retriever
+                self.retrieval = Retriever(self.store)
+            except ModuleNotFoundError as err:
+                print(f'[red]\[x] retrieval needs numpy and ollama: {err}[/red]')
+                return
+            try:
+                self.retrieval.check()
+            except Exception as err:
+                print(f'[red]\[x] embedding model {self.retrieval.model} is not available: {type(err).__name__}: {err}[/red]')
+                self.retrieval.close()
+                self.retrieval = None
+                return
+            self.retrieval.index_conversations()
+        print(f'[*] retrieval set to: {self.retrieval is not None}')
+
+    def show_tokens(self):
+        """show prompt tokens against model's budget"""
+        print(f'[*] prompt: {self.window.describe(self.messages)}')
+        if self.retrieval is not None:
+            print(f'[*] retrieval: {len(self.retrieval.index)} turns indexed, {len(self.retrieval.last)} sent with last question')
+        if self.token_usage.turns:
+            print(f'[*] conversation: {self.token_usage.describe(self.model)}')
+
+    def show_stats(self):
+        """show latency and throughput per model"""
+        if self.metrics is None:
+            print('[*] stats are disabled')
+            return
+        self.metrics.show()
+
+    def show_cache(self):
+        """show responses cache hits and misses"""
+        if self.cache is None:
+            print('[*] cache is disabled')
+            return
+        stats = self.cache.stats()
+        print(f"[*] cache: hits={stats['hits']} misses={stats['misses']} hit rate={stats['hit_rate']:.1%} entries={stats['entries']} size={stats['bytes'] / 1024:.0f}KB")
+
     def __now(self):
         """datetime now"""
         return time.strftime("%Y%m%d%H%M%S")
 
+    def __persist(self, message):
+        """append message to conversation log, as it happens"""
+        if self.conversation_path is None:
+            self.conversation_path = self.store.create(self.conversation_id, self.model, self.system_message)
+            self.conversation_id = self.conversation_path.stem.split('-', maxsplit=1)[0]
+        self.store.append(self.conversation_path, message)
+        if self.retrieval is not None and message.get('role') == 'assistant':
+            turn = sum(1 for item in self.messages if item and item.get('role') == 'user')
+            self.retrieval.add_turn(self.conversation_path.name, turn, self.messages[-2]['content'], message['content'])
+
     def save_conversation(self):
-        if len(self.messages) < 2:
-            # we skip system message
+        """finish current conversation, next question starts new one"""
+        self.window.reset()
+        if self.conversation_path is None:
+            # nothing asked yet
             return
-        directory = Path('conversations')
-        directory.mkdir(exist_ok=True)
-        filename = f'{self.conversation_id}-{self.model}.json'
-        path = directory / filename
-        write_json(path, self.messages)
-        print(f"[*] conversation saved to: [cyan]{path}[/cyan]")
+        if self.token_usage.added:
+            self.store.update_meta(self.conversation_path, usage=self.token_usage.summary(self.model))
+            print(f"[*] tokens: {self.token_usage.describe(self.model)}")
+        self.token_usage = ConversationUsage()
+        self.store.close(self.conversation_path)
+        print(f"[*] conversation saved to: [cyan]{self.conversation_path}[/cyan]")
         self.conversation_id = self.__now()
+        self.conversation_path = None
 
-    def load_conversation(self):
+    def load_conversation(self, path_to_load=None):
+        """load conversation, picked from list unless path is given"""
         self.save_conversation()  # save current conversation
-        conversations_directory = Path('conversations')
-        conversations_list = [item for item in conversations_directory.iterdir() if item.suffix == '.json']
-        conversations_match = {str(index):item for index, item in enumerate(conversations_list, start=1)}
-        conversations_str = '\n'.join([f'    {key}) [cyan]{path}[/cyan]' for (key, path) in conversations_match.items()])
-        choose_list = f'[*] choose from list:\n{conversations_str}'
-        print(choose_list)
-        try:
-            load_input = input()
-        except KeyboardInterrupt:
-            print()
-            return False
-        path_to_load = conversations_match.get(load_input, False)
+        if path_to_load is None:
+            migrated = self.store.migrate()
+            if migrated:
+                print(f'[*] imported {len(migrated)} conversations from .json files')
+            path_to_load = choose_conversation(self.store)
         if not path_to_load:
-            print(f'[red]\[x] wrong choice')
             return False
-        loaded_messages = read_json(path_to_load)
+        loaded_messages, meta = self.store.read(path_to_load)
         if not loaded_messages:
-            print(f'[red]\[x] failed to load conversation from: {load_input}')
+            print(f'[red]\[x] failed to load conversation from: {path_to_load}')
         else:
             self.messages = loaded_messages
-            self.conversation_id = path_to_load.stem.split('-', maxsplit=1)[0]
+            self.conversation_id = meta.get('id', path_to_load.stem.split('-', maxsplit=1)[0])
+            self.conversation_path = path_to_load
+            self.token_usage = ConversationUsage(meta.get('usage'))
+            self.window.reset()
             print(f'[green][*] conversation loaded')
 
+    def search(self, terms):
+        """search all conversations, load the one picked from results"""
+        if self.conversation_path is not None:
+            # make current conversation searchable too
+            self.store.index.update(self.conversation_path)
+        path_to_load = search_conversations(self.store, terms)
+        if path_to_load:
+            self.load_conversation(path_to_load)
+
     def usage(self):
         print("Usage")
         print("    cls, clear       -clear terminal")
         print("    exit, quit       -clear terminal")
         print("    context          -switch context flag")
+        print("    stream           -switch stream flag")
+        print("    retrieval        -send relevant earlier turns instead of whole history")
+        print("    tokens           -show prompt tokens against budget and token usage")
+        print("    stats            -show latency and throughput stats")
+        print("    cache            -show cache hits/misses")
+        print("    cache clear      -remove cached answers")
+        print("    !<question>      -ask, bypassing cache")
+        print("    &<question>      -ask in background, keep working meanwhile")
+        print("    fanout <q>       -ask several models at once")
+        print("    session <name>   -switch to session, new one optionally with [backend:]model")
+        print("    sessions         -list sessions")
+        print("    show             -show answers which came in background")
         print("    model            -show current model")
+        print("    model <name>     -switch model, starts new conversation")
         print("    models           -list all models")
         print("    id               -conversation ID")
         print("    load             -load conversation")
-        print("    talk             -show talk messages")
+        print("    search <terms>   -search conversations, load found one")
+        print("    compact          -compact conversation logs")
+        print("    talk             -page through conversation")
         print("    help             -this usage")
 
 
 class GPTClient:
-    def __init__(self, model, system_message=None, context=True):
+    __backend = 'openai'
+
+    def __init__(self, model, system_message=None, context=True, stream=True, cache=None, store=None, budget=None, summarize=False, metrics=None):
         self.model = model  # gpt-4, gpt-3.5-turbo
-        config = dotenv_values()
-        self.client = OpenAI(api_key=config["OPENAI-API-KEY"])
+        self._client = None
         self.system_message = system_message
         self.messages = [self.system_message]
         self.context = context
+        self.stream = stream
+        self.cache = cache
+        self.store = store or ConversationStore()
+        self.window = ContextWindow(model, budget, summarize, length=context_length(model, OPENAI_CONTEXT_LENGTH))
+        self.metrics = metrics
+        self.token_usage = ConversationUsage()  # of current conversation, saved with it
+        self.retrieval = None  # Retriever, when only relevant earlier turns are sent
+        self.temperature = 0.5
         self.conversation_id = self.__now()
+        self.conversation_path = None
 
-    def ask(self, content):
+    @property
+    def client(self):
+        """openai client, created on first use"""
+        if self._client is None:
+            from dotenv import dotenv_values
+            from openai import OpenAI
+            config = dotenv_values()
+            self._client = OpenAI(api_key=config.get("OPENAI-API-KEY"))  # OPENAI_API_KEY and OPENAI_BASE_URL env variables work too
+        return self._client
+
+    def ask(self, content, use_cache=True):
         user_message = {"role": "user", "content": content}
         if self.context:
             self.messages.append(user_message)
         else:
             self.messages = [self.system_message, user_message]
+        self.__persist(user_message)
+        try:
+            answer = run_cancellable(self.complete, self.__window(), use_cache)
+            reply = {"role": "assistant", "content": answer}
+        except KeyboardInterrupt:
+            # whole answer comes at once, so there is nothing to keep but the mark
+            answer = ''
+            reply = {"role": "assistant", "content": answer, "truncated": True}
+
+        # keep conversation anyway
+        self.messages.append(reply)
+        self.__persist(reply)
+        return answer
+
+    def complete(self, messages, use_cache=True):
+        """answer to messages, conversation is not changed, so it can be called from many threads"""
+        key = self.__cache_key(messages, use_cache)
+        turn = self.metrics.start(self.model, self.__backend, messages) if self.metrics else None
+        answer = self.cache.get(key) if key else None
+        if answer is not None:
+            if turn:
+                self.metrics.record(turn.finish(cache_hit=True))
+            return answer
         response = self.client.chat.completions.create(
                 model=self.model,
                 n=1,
-                temperature=0.5,
-                messages=self.messages,
+                temperature=self.temperature,
+                messages=messages,
         )
-        reply = response.choices[0].message.model_dump()
-        del reply['function_call']
-        del reply['tool_calls']
-        del reply['refusal']
+        usage = openai_usage(response.usage)
+        if turn:
+            self.metrics.record(turn.finish(**usage))
+        self.token_usage.add(usage, turn.data['ttft'] if turn else None)
+        answer = response.choices[0].message.content
+        if key:
+            self.cache.put(key, answer)
+        return answer
 
+    def ask_stream(self, content, use_cache=True, cancelled=None):
+        """ask model and yield answer chunks as they arrive
+
+        Setting cancelled (threading.Event) from another thread ends the answer as truncated,
+        also before its first chunk.
+        """
+        user_message = {"role": "user", "content": content}
+        if self.context:
+            self.messages.append(user_message)
+        else:
+            self.messages = [self.system_message, user_message]
+        self.__persist(user_message)
+        messages = self.__window()
+        key = self.__cache_key(messages, use_cache)
+        turn = self.metrics.start(self.model, self.__backend, messages) if self.metrics else None
+        answer = self.cache.get(key) if key else None
+        if answer is not None:
+            reply = {"role": "assistant", "content": answer}
+            self.messages.append(reply)
+            self.__persist(reply)
+            if turn:
+                self.metrics.record(turn.finish(cache_hit=True))
+            yield answer
+            return
+        generation = Generation(lambda: self.client.chat.completions.create(
+                model=self.model,
+                n=1,
+                temperature=self.temperature,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+        ), cancelled)
+        chunks = []
+        usage = {}
+        truncated = True
+        try:
+            for chunk in generation:
+                if chunk.usage:
+                    usage = openai_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                token = chunk.choices[0].delta.content
+                if not token:
+                    continue
+                if turn:
+                    turn.token()
+                chunks.append(token)
+                yield token
+            truncated = generation.cancelled.is_set()
+        except KeyboardInterrupt:
+            # stop generation, keep what was answered so far
+            pass
+        finally:
+            self.__finish_stream(generation, chunks, truncated, turn, usage, key)
+
+    def __finish_stream(self, generation, chunks, truncated, turn, usage, key):
+        """keep streamed answer, also when it was interrupted (by Ctrl+C or closed generator)"""
+        generation.cancel()
+        if turn:
+            self.metrics.record(turn.finish(truncated=truncated, **usage))
+        if usage:
+            self.token_usage.add(usage, turn.data['ttft'] if turn else None)
+        reply = {"role": "assistant", "content": "".join(chunks)}
+        if truncated:
+            reply['truncated'] = True
         # keep conversation anyway
         self.messages.append(reply)
+        self.__persist(reply)
+        if key and not truncated:
+            self.cache.put(key, reply['content'])
 
-        answer = reply['content']
-        return answer
+    def __cache_key(self, messages, use_cache):
+        """key of current request in responses cache, None if cache is not used"""
+        if (self.cache is None) or not use_cache:
+            return None
+        return ResponseCache.make_key(self.__backend, self.model, self.temperature, messages)
+
+    def __window(self):
+        """messages to send, trimmed to model's token budget"""
+        if not self.context:
+            return request_messages(self.messages)
+        if self.retrieval is not None:
+            # history changes with every question, so there is nothing to summarize
+            messages = self.retrieval.select(self.messages, self.conversation_path.name)
+            if messages is not None:
+                # retrieved turns change with every question, so there is no stable prefix to keep
+                return request_messages(self.window.select(messages, stable=False))
+        return request_messages(self.window.select(self.messages, self.__summarize))
+
+    def __summarize(self, summary, messages):
+        response = self.client.chat.completions.create(
+                model=self.model,
+                n=1,
+                temperature=0,
+                messages=summary_request(summary, messages),
+        )
+        return response.choices[0].message.content
+
+    def warm_up(self):
+        """import openai and create client in background, so first question doesn't wait for it"""
+        threading.Thread(target=lambda: self.client, daemon=True).start()
 
     def get_models(self):
         """show information about locally available models"""
@@ -168,6 +560,14 @@ class GPTClient:
         """show information about currently used model"""
         print(f'[*] current model: {self.model}')
 
+    def switch_model(self, model):
+        """continue with another model, in new conversation"""
+        self.save_conversation()
+        self.model = model
+        self.messages = [self.system_message]
+        self.window = ContextWindow(model, summarize=self.window.summarize, length=context_length(model, OPENAI_CONTEXT_LENGTH))
+        print(f'[*] model set to: {self.model}')
+
     def switch_context(self):
         self.context = not self.context
         if not self.context:
@@ -175,165 +575,421 @@ class GPTClient:
             self.messages = [self.system_message]
         print(f'[*] context set to: {self.context}')
 
+    def switch_stream(self):
+        self.stream = not self.stream
+        print(f'[*] stream set to: {self.stream}')
+
+    def switch_retrieval(self):
+        """send only relevant earlier turns and recent messages, instead of whole history"""
+        if self.retrieval is not None:
+            self.retrieval.close()
+            self.retrieval = None
+        else:
+            try:
+                from retrieval import Retriever
+                self.retrieval = Retriever(self.store)
+            except ModuleNotFoundError as err:
+                print(f'[red]\[x] retrieval needs numpy and ollama: {err}[/red]')
+                return
+            try:
+                self.retrieval.check()
+            except Exception as err:
+                print(f'[red]\[x] embedding model {self.retrieval.model} is not available: {type(err).__name__}: {err}[/red]')
+                self.retrieval.close()
+                self.retrieval = None
+                return
+            self.retrieval.index_conversations()
+        print(f'[*] retrieval set to: {self.retrieval is not None}')
+
+    def show_tokens(self):
+        """show prompt tokens against model's budget"""
+        print(f'[*] prompt: {self.window.describe(self.messages)}')
+        if self.retrieval is not None:
+            print(f'[*] retrieval: {len(self.retrieval.index)} turns indexed, {len(self.retrieval.last)} sent with last question')
+        if self.token_usage.turns:
+            print(f'[*] conversation: {self.token_usage.describe(self.model)}')
+
+    def show_stats(self):
+        """show latency and throughput per model"""
+        if self.metrics is None:
+            print('[*] stats are disabled')
+            return
+        self.metrics.show()
+
+    def show_cache(self):
+        """show responses cache hits and misses"""
+        if self.cache is None:
+            print('[*] cache is disabled')
+            return
+        stats = self.cache.stats()
+        print(f"[*] cache: hits={stats['hits']} misses={stats['misses']} hit rate={stats['hit_rate']:.1%} entries={stats['entries']} size={stats['bytes'] / 1024:.0f}KB")
+
     def __now(self):
         """datetime now"""
         return time.strftime("%Y%m%d%H%M%S")
 
+    def __persist(self, message):
+        """append message to conversation log, as it happens"""
+        if self.conversation_path is None:
+            self.conversation_path = self.store.create(self.conversation_id, self.model, self.system_message)
+            self.conversation_id = self.conversation_path.stem.split('-', maxsplit=1)[0]
+        self.store.append(self.conversation_path, message)
+        if self.retrieval is not None and message.get('role') == 'assistant':
+            turn = sum(1 for item in self.messages if item and item.get('role') == 'user')
+            self.retrieval.add_turn(self.conversation_path.name, turn, self.messages[-2]['content'], message['content'])
+
     def save_conversation(self):
-        if len(self.messages) < 2:
-            # we skip system message
+        """finish current conversation, next question starts new one"""
+        self.window.reset()
+        if self.conversation_path is None:
+            # nothing asked yet
             return
-        directory = Path('conversations')
-        directory.mkdir(exist_ok=True)
-        filename = f'{self.conversation_id}-{self.model}.json'
-        path = directory / filename
-        write_json(path, self.messages)
-        print(f"[*] conversation saved to: [cyan]{path}[/cyan]")
+        if self.token_usage.added:
+            self.store.update_meta(self.conversation_path, usage=self.token_usage.summary(self.model))
+            print(f"[*] tokens: {self.token_usage.describe(self.model)}")
+        self.token_usage = ConversationUsage()
+        self.store.close(self.conversation_path)
+        print(f"[*] conversation saved to: [cyan]{self.conversation_path}[/cyan]")
         self.conversation_id = self.__now()
+        self.conversation_path = None
 
-    def load_conversation(self):
+    def load_conversation(self, path_to_load=None):
+        """load conversation, picked from list unless path is given"""
         self.save_conversation()  # save current conversation
-        conversations_directory = Path('conversations')
-        conversations_list = [item for item in conversations_directory.iterdir() if item.suffix == '.json']
-        conversations_match = {str(index):item for index, item in enumerate(conversations_list, start=1)}
-        conversations_str = '\n'.join([f'    {key}) [cyan]{path}[/cyan]' for (key, path) in conversations_match.items()])
-        choose_list = f'[*] choose from list:\n{conversations_str}'
-        print(choose_list)
-        try:
-            load_input = input()
-        except KeyboardInterrupt:
-            print()
-            return False
-        path_to_load = conversations_match.get(load_input, False)
+        if path_to_load is None:
+            migrated = self.store.migrate()
+            if migrated:
+                print(f'[*] imported {len(migrated)} conversations from .json files')
+            path_to_load = choose_conversation(self.store)
         if not path_to_load:
-            print(f'[red]\[x] wrong choice')
             return False
-        loaded_messages = read_json(path_to_load)
+        loaded_messages, meta = self.store.read(path_to_load)
         if not loaded_messages:
-            print(f'[red]\[x] failed to load conversation from: {load_input}')
+            print(f'[red]\[x] failed to load conversation from: {path_to_load}')
         else:
             self.messages = loaded_messages
-            self.conversation_id = path_to_load.stem.split('-', maxsplit=1)[0]
+            self.conversation_id = meta.get('id', path_to_load.stem.split('-', maxsplit=1)[0])
+            self.conversation_path = path_to_load
+            self.token_usage = ConversationUsage(meta.get('usage'))
+            self.window.reset()
             print(f'[green][*] conversation loaded')
 
+    def search(self, terms):
+        """search all conversations, load the one picked from results"""
+        if self.conversation_path is not None:
+            # make current conversation searchable too
+            self.store.index.update(self.conversation_path)
+        path_to_load = search_conversations(self.store, terms)
+        if path_to_load:
+            self.load_conversation(path_to_load)
+
     def usage(self):
         print("Usage")
         print("    cls, clear       -clear terminal")
         print("    exit, quit       -clear terminal")
         print("    context          -switch context flag")
+        print("    stream           -switch stream flag")
+        print("    retrieval        -send relevant earlier turns instead of whole history")
+        print("    tokens           -show prompt tokens against budget and token usage")
+        print("    stats            -show latency and throughput stats")
+        print("    cache            -show cache hits/misses")
+        print("    cache clear      -remove cached answers")
+        print("    !<question>      -ask, bypassing cache")
+        print("    &<question>      -ask in background, keep working meanwhile")
+        print("    fanout <q>       -ask several models at once")
+        print("    session <name>   -switch to session, new one optionally with [backend:]model")
+        print("    sessions         -list sessions")
+        print("    show             -show answers which came in background")
         print("    model            -show current model")
+        print("    model <name>     -switch model, starts new conversation")
         print("    models           -list all models")
         print("    id               -conversation ID")
         print("    load             -load conversation")
-        print("    talk             -show talk messages")
+        print("    search <terms>   -search conversations, load found one")
+        print("    compact          -compact conversation logs")
+        print("    talk             -page through conversation")
         print("    help             -this usage")
 
 
-def write_json(filename, data):
-    """write to json file"""
-    with open(filename, 'w', encoding='utf-8') as fp:
-        json.dump(data, fp, sort_keys=True, indent=4, ensure_ascii=False)
-    return True
+class Generation:
+    """Streamed response read by background thread, so waiting for it can be interrupted with Ctrl+C.
 
+    cancel() makes the thread stop at next chunk and close the response, which frees the connection.
+    Iteration ends as soon as cancelled is set, also while waiting for the first chunk.
+    """
+    def __init__(self, request, cancelled=None):
+        self.chunks = queue.Queue()
+        self.cancelled = cancelled or threading.Event()
+        self.response = None
+        self.thread = threading.Thread(target=self._read, args=(request,), daemon=True)
+        self.thread.start()
 
-def read_json(filename):
-    """read json file to dict"""
-    data = {}
-    try:
-        with open(filename, encoding='utf-8') as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        print('[x] FileNotFoundError: {}'.format(filename))
-    return data
+    def _read(self, request):
+        try:
+            self.response = request()
+            for chunk in self.response:
+                if self.cancelled.is_set():
+                    break
+                self.chunks.put(chunk)
+        except Exception as err:
+            if not self.cancelled.is_set():
+                self.chunks.put(err)
+        finally:
+            if hasattr(self.response, 'close'):
+                self.response.close()
+            self.chunks.put(None)
 
+    def __iter__(self):
+        while not self.cancelled.is_set():
+            try:
+                # timeout keeps waiting interruptible on every platform, and lets cancel end it
+                chunk = self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
 
-def split_codeblocks(text):
-    """Extracts the code block section from a markdown text."""
-    lines = iter(text.splitlines())
-    blocks = []
-    rows = []
-    skip = False
+    def cancel(self):
+        self.cancelled.set()
+        try:
+            # closing response here breaks waiting for next chunk at once (openai stream)
+            self.response.close()
+        except (AttributeError, ValueError):
+            # no response yet, or generator (ollama) which only reading thread can close
+            pass
+
+
+def run_cancellable(func, *args):
+    """run func in background thread and wait for its result, Ctrl+C stops waiting"""
+    results = queue.Queue()
+
+    def run():
+        try:
+            results.put((func(*args), None))
+        except Exception as err:
+            results.put((None, err))
+
+    threading.Thread(target=run, daemon=True).start()
     while True:
-        if not skip:
-            line = next(lines, None)
-            if line is None:
-                break
-        if line.startswith("```"):
-            skip = False
-            block_type = line.removeprefix("```").strip()
-            while True:
-                line = next(lines, None)
-                if (line is None) or (line.startswith("```")):
-                    if rows:
-                        block = Block(content="\n".join(rows), type=block_type)
-                        blocks.append(block)
-                        rows = []
-                    break
-                else:
-                    rows.append(line)
+        try:
+            result, err = results.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if err is not None:
+            raise err
+        return result
+
+
+def request_messages(messages):
+    """messages as api expects them, without local marks like "truncated" """
+    return [{"role": message["role"], "content": message["content"]} if message and 'truncated' in message else message for message in messages]
+
+
+class BlockParser:
+    """Incremental markdown code block parser, fed with text chunks of any size.
+
+    Returns Block objects as soon as they are closed. Fences split across chunks are
+    handled, every character is looked at once. With stream_text=True, text is returned
+    in pieces as soon as it can't be a part of code fence, instead of whole text blocks.
+    """
+    def __init__(self, stream_text=False):
+        self.stream_text = stream_text
+        self.block_type = None  # None for text, language for code section
+        self.rows = []  # rows of current block
+        self.pieces = []  # pieces of current, unfinished line
+        self.head = ''  # first (up to 3) chars of current line
+        self.streamed = False  # current line already returned as text
+
+    def feed(self, chunk):
+        """feed parser with next chunk of text, return closed blocks"""
+        blocks = []
+        first, *lines = chunk.split('\n')
+        if not lines:
+            if first:
+                self._add(first, blocks)
+            return blocks
+        self._add(first, blocks)
+        self._end_line(blocks)
+        rest = lines.pop()
+        for line in lines:
+            self._line(line, blocks)
+        if rest:
+            self._add(rest, blocks)
+        return blocks
+
+    def close(self):
+        """finish parsing, return remaining blocks"""
+        blocks = []
+        if self.stream_text and self.block_type is None:
+            if self.pieces:
+                blocks.append(Block(content="".join(self.pieces), type='text'))
+        elif self.pieces:
+            self._end_line(blocks)
+        if self.rows:
+            block_type = 'text' if self.block_type is None else self.block_type
+            blocks.append(Block(content="\n".join(self.rows), type=block_type))
+        self.__init__(stream_text=self.stream_text)
+        return blocks
+
+    def _add(self, piece, blocks):
+        """add piece of unfinished line"""
+        if len(self.head) < 3:
+            self.head += piece[:3 - len(self.head)]
+        if self.stream_text and self.block_type is None and not is_fence_prefix(self.head):
+            if self.pieces:
+                piece = "".join(self.pieces) + piece
+                self.pieces = []
+            if piece:
+                blocks.append(Block(content=piece, type='text'))
+            self.streamed = True
         else:
-            block_type = 'text'
-            rows.append(line)
-            while True:
-                line = next(lines, None)
-                if (line is not None) and line.startswith("```"):
-                    # to change state, to go code section
-                    skip = True
-                if (line is None) or (line.startswith("```")):
-                    if rows:
-                        block = Block(content="\n".join(rows), type=block_type)
-                        blocks.append(block)
-                        rows = []
-                    break
-                else:
-                    rows.append(line)
-    return blocks
+            self.pieces.append(piece)
+
+    def _end_line(self, blocks):
+        """finish line built from pieces"""
+        line = "".join(self.pieces)
+        streamed = self.streamed
+        self.pieces, self.head, self.streamed = [], '', False
+        if streamed:
+            blocks.append(Block(content=line + '\n', type='text'))
+        else:
+            self._line(line, blocks)
+
+    def _line(self, line, blocks):
+        """handle complete line"""
+        line = line.removesuffix('\r')
+        if self.block_type is None:
+            if line.startswith("```"):
+                if self.rows:
+                    blocks.append(Block(content="\n".join(self.rows), type='text'))
+                    self.rows = []
+                self.block_type = line.removeprefix("```").strip()
+            elif self.stream_text:
+                blocks.append(Block(content=line + '\n', type='text'))
+            else:
+                self.rows.append(line)
+        elif line.startswith("```"):
+            if self.rows:
+                blocks.append(Block(content="\n".join(self.rows), type=self.block_type))
+                self.rows = []
+            self.block_type = None
+        else:
+            self.rows.append(line)
+
+
+def is_fence_prefix(line):
+    """check if line is (or may become) a code fence"""
+    return line.startswith("```") or "```".startswith(line)
+
+
+def split_codeblocks(text):
+    """Extracts the code block section from a markdown text."""
+    parser = BlockParser()
+    return parser.feed(text) + parser.close()
+
+
+class RenderCache:
+    """Rendered output (ansi text) keyed by content hash, terminal width and colors.
+
+    Highlighting code with rich takes much longer than printing its result, and the same
+    answers are shown many times, e.g. when paging through conversation with talk.
+    Least recently used entries are dropped when cache grows over max_bytes.
+    """
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def print(self, kind, content, render):
+        """print what render(console) prints for content of that kind, rendering it only once"""
+        console = get_console()
+        console.file.write(self.render(kind, content, render))
+        console.file.flush()
+
+    def render(self, kind, content, render):
+        """what render(console) prints, from cache if it was rendered before"""
+        console = get_console()
+        digest = hashlib.blake2b(content.encode('utf-8', errors='replace'), digest_size=16).digest()
+        key = (kind, digest, console.width, console.color_system)
+        with self.lock:
+            text = self.items.get(key)
+            if text is not None:
+                self.items.move_to_end(key)
+        if text is None:
+            with console.capture() as capture:
+                render(console)
+            text = capture.get()
+            with self.lock:
+                if key not in self.items:
+                    self.items[key] = text
+                    self.bytes += len(text)
+                while self.bytes > self.max_bytes and len(self.items) > 1:
+                    _, dropped = self.items.popitem(last=False)
+                    self.bytes -= len(dropped)
+        return text
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+
+RENDER_CACHE = RenderCache()
+KNOWN_LANGUAGES = frozenset({
+    "bash",
+    "cpp",
+    "css",
+    "dart",
+    "go",
+    "groovy",
+    "haskell",
+    "html",
+    "java",
+    "javascript",
+    "json",
+    "julia",
+    "kotlin",
+    "lua",
+    "markdown",
+    "matlab",
+    "perl",
+    "php",
+    "powershell",
+    "python",
+    "r",
+    "ruby",
+    "rust",
+    "scala",
+    "sql",
+    "swift",
+    "typescript",
+    "xml",
+    "yaml",
+})
 
 
 def show_block(block):
     """Highlights a code block using the rich library."""
+    RENDER_CACHE.print(*block_render(block))
+
+
+def block_render(block):
+    """(kind, content, render) of block, as taken by RENDER_CACHE"""
     if block.type == "text":
-        print(f'[yellow]{block.content}[/yellow]')
-        return
-    known_languages = {
-        "bash",
-        "cpp",
-        "css",
-        "dart",
-        "go",
-        "groovy",
-        "haskell",
-        "html",
-        "java",
-        "javascript",
-        "json",
-        "julia",
-        "kotlin",
-        "lua",
-        "markdown",
-        "matlab",
-        "perl",
-        "php",
-        "powershell",
-        "python",
-        "r",
-        "ruby",
-        "rust",
-        "scala",
-        "sql",
-        "swift",
-        "typescript",
-        "xml",
-        "yaml"
-    }
-    if block.type in known_languages:
-        language = block.type
-    else:
-        language = None
-    highlight_code(block.content, language, codebox=True)
+        return 'text', block.content, lambda console: console.print(f'[yellow]{block.content}[/yellow]')
+    language = block.type if block.type in KNOWN_LANGUAGES else None
+    return f'code:{language}', block.content, lambda console: console.print(highlight_code(block.content, language))
 
 
-def highlight_code(content, language, codebox=False):
+def highlight_code(content, language):
+    """code in a box, highlighted if language is known"""
+    from rich.columns import Columns
+    from rich.panel import Panel
+    from rich.syntax import Syntax
     highlighted = Syntax(
         content,
         language,
@@ -342,19 +998,201 @@ def highlight_code(content, language, codebox=False):
         indent_guides=False,
         word_wrap=True
     )
-    highlighted = Columns([Panel(highlighted)])
-    print(highlighted)
+    return Columns([Panel(highlighted)])
+
+
+class StreamPrinter:
+    """Prints streamed answer as it arrives, highlights code blocks once they are closed."""
+    def __init__(self):
+        self.parser = BlockParser(stream_text=True)
+        self.newline = False
+        self.render_time = 0
+
+    def write(self, chunk):
+        start = time.perf_counter()
+        for block in self.parser.feed(chunk):
+            self._show(block)
+        self.render_time += time.perf_counter() - start
 
+    def close(self):
+        start = time.perf_counter()
+        for block in self.parser.close():
+            self._show(block)
+        if not self.newline:
+            self._echo('\n')
+        self.render_time += time.perf_counter() - start
+
+    def _show(self, block):
+        if block.type == 'text':
+            self._echo(block.content)
+            return
+        if not self.newline:
+            self._echo('\n')
+        show_block(block)
+        self.newline = True
+
+    def _echo(self, text):
+        if not text:
+            return
+        sys.stdout.write(f'{Color.YELLOW}{text}{Color.RESET}')
+        sys.stdout.flush()
+        self.newline = text.endswith('\n')
+
+
+def pretty_print_stream(chunks, metrics=None):
+    """print answer chunks as they arrive, highlight codeblocks once closed"""
+    print('[*] gpt: ', end='')
+    printer = StreamPrinter()
+    try:
+        for chunk in chunks:
+            printer.write(chunk)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # stops generation if it was interrupted, partial answer is kept
+        chunks.close()
+    printer.close()
+    if metrics:
+        metrics.update(render=printer.render_time)
 
-def pretty_print_answer(answer):
+
+def pretty_print_answer(answer, metrics=None):
     """split into codeblocks and highlight"""
+    start = time.perf_counter()
+    for render in answer_renders(answer):
+        RENDER_CACHE.print(*render)
+    if metrics:
+        metrics.update(render=time.perf_counter() - start)
+
+
+def answer_renders(answer):
+    """(kind, content, render) of answer parts, as taken by RENDER_CACHE"""
     blocks = split_codeblocks(answer)
     if (len(blocks) == 1) and blocks[0].type == 'text':
-        print(f'[*] gpt: [yellow]{answer}[/yellow]')
-    else:
-        print(f'[*] gpt:')
-        for block in blocks:
-            show_block(block)
+        return [('answer', answer, lambda console: console.print(f'[*] gpt: [yellow]{answer}[/yellow]'))]
+    return [('header', '', lambda console: console.print('[*] gpt:'))] + [block_render(block) for block in blocks]
+
+
+def show_talk(messages, page_size=5, interactive=True):
+    """page through conversation, starting from the newest turns, only turns of shown page are rendered"""
+    starts = [index for index, message in enumerate(messages) if message and message.get('role') == 'user']
+    if not starts:
+        print('[*] no messages yet')
+        return
+    pages = (len(starts) + page_size - 1) // page_size
+    page = pages - 1
+    while True:
+        show_talk_page(messages, starts, page, page_size)
+        if not interactive or pages == 1:
+            return
+        if page > 0:
+            # older page is rendered while this one is read, so going back is instant
+            threading.Thread(target=prerender_talk_page, args=(messages, starts, page - 1, page_size), daemon=True).start()
+        print(f'[*] n/p next/previous page, page number (1-{pages}), empty to close:')
+        try:
+            page_input = input().strip()
+        except KeyboardInterrupt:
+            print()
+            return
+        if not page_input:
+            return
+        elif page_input == 'n':
+            page = min(page + 1, pages - 1)
+        elif page_input == 'p':
+            page = max(page - 1, 0)
+        elif page_input.isdigit() and 1 <= int(page_input) <= pages:
+            page = int(page_input) - 1
+
+
+def talk_page(messages, starts, page, page_size):
+    """first and last turn of page and its messages, starts are indexes of user messages"""
+    first = page * page_size
+    last = min(first + page_size, len(starts))
+    end = starts[last] if last < len(starts) else len(messages)
+    return first + 1, last, messages[starts[first]:end]
+
+
+def prerender_talk_page(messages, starts, page, page_size):
+    for message in talk_page(messages, starts, page, page_size)[2]:
+        if message and message.get('role') == 'assistant':
+            for render in answer_renders(message.get('content') or ''):
+                RENDER_CACHE.render(*render)
+
+
+def show_talk_page(messages, starts, page, page_size):
+    """print turns of single page, only they are rendered"""
+    from rich.markup import escape
+    first, last, page_messages = talk_page(messages, starts, page, page_size)
+    pages = (len(starts) + page_size - 1) // page_size
+    print(f'[*] talk: turns {first}-{last} of {len(starts)} (page {page + 1}/{pages})')
+    for message in page_messages:
+        if not message:
+            continue
+        content = message.get('content') or ''
+        if message.get('role') == 'user':
+            print(f'[cyan][*] you:[/cyan] {escape(content)}')
+        elif message.get('role') == 'assistant':
+            pretty_print_answer(content)
+            if message.get('truncated'):
+                print('[*] answer truncated')
+
+
+def choose_conversation(store, page_size=20):
+    """pick conversation from index: most recent first, paged, fuzzy filtered"""
+    from rich.markup import escape
+    changes = store.index.refresh()
+    if changes:
+        print(f'[*] conversations index updated: {changes} changes')
+    pattern = ''
+    page = 0
+    while True:
+        rows = store.index.query(pattern, limit=page_size, offset=page*page_size)
+        print(f'[*] conversations (page {page+1}' + (f', filter: [cyan]{pattern}[/cyan]' if pattern else '') + '):')
+        for index, row in enumerate(rows, start=1):
+            updated = time.strftime('%Y-%m-%d %H:%M', time.localtime(row['updated']))
+            print(f"    {index:>2}) {updated} [cyan]{row['model']:<16}[/cyan] {row['turns']:>4} turns {row['bytes'] / 1024:>7.1f}KB  {escape(row['first_line'])}")
+        if not rows:
+            print('    no conversations')
+        print('[*] number to load, n/p next/previous page, text to filter, empty to cancel:')
+        try:
+            load_input = input().strip()
+        except KeyboardInterrupt:
+            print()
+            return None
+        if not load_input:
+            return None
+        elif load_input.isdigit() and 1 <= int(load_input) <= len(rows):
+            return store.directory / rows[int(load_input) - 1]['name']
+        elif load_input == 'n':
+            page += len(rows) == page_size
+        elif load_input == 'p':
+            page = max(page - 1, 0)
+        else:
+            pattern = load_input
+            page = 0
+
+
+def search_conversations(store, terms, limit=20):
+    """ranked messages matching terms in all conversations, return path of picked one"""
+    from rich.markup import escape
+    start = time.perf_counter()
+    hits = store.index.search(terms, limit)
+    elapsed = time.perf_counter() - start
+    print(f'[*] found {len(hits)} messages in {elapsed * 1000:.1f}ms:')
+    for index, hit in enumerate(hits, start=1):
+        snippet = escape(' '.join(hit['snippet'].split())).replace('\x01', '[bold cyan]').replace('\x02', '[/bold cyan]')
+        print(f"    {index:>2}) [cyan]{hit['id']}[/cyan] {hit['model']} turn {hit['turn']} {hit['role']}: [yellow]{snippet}[/yellow]")
+    if not hits:
+        return None
+    print('[*] number to load, empty to cancel:')
+    try:
+        load_input = input().strip()
+    except KeyboardInterrupt:
+        print()
+        return None
+    if load_input.isdigit() and 1 <= int(load_input) <= len(hits):
+        return store.directory / hits[int(load_input) - 1]['name']
+    return None
 
 
 def clear():
@@ -366,22 +1204,81 @@ def clear():
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(usage="python chat.py [--ollama] [--model MODEL]\n       python chat.py --batch prompts.jsonl [-o answers.jsonl] [--ollama] [--model MODEL]")
+    parser.add_argument("--model", help="Model of chat client, gpt-4o by default, codellama with --ollama")
+    parser.add_argument("--ollama", action='store_true', help="Use Ollama instead of OpenAI")
+    parser.add_argument("--batch", help="JSONL file with prompts (or messages lists) to answer without interaction, - for stdin")
+    parser.add_argument("-o", "--output", default="answers.jsonl", help="JSONL file for batch results (appended, resumable)")
+    parser.add_argument("-w", "--workers", default=4, type=int, help="Number of requests in flight in batch mode")
+    parser.add_argument("--retries", default=5, type=int, help="Number of retries per prompt on rate limit and server errors")
+    parser.add_argument("--completion-order", action='store_true', help="Write batch results as they complete, not in input order")
+    parser.add_argument("--no-cache", action='store_true', help="Don't use responses cache")
+    args = parser.parse_args()
+    if args.batch and args.batch != '-':
+        args.batch = os.path.abspath(args.batch)
+    args.output = os.path.abspath(args.output)
     os.chdir(str(Path(__file__).parent))
     if os.name == 'nt':
         os.system('color')
 
     # **** create chat client ****
-    system_message = {
-        "role": "system",
-        "content": "rule: reply directly without long summaries and comments, in few words"
-    }
-    # client = OllamaClient(model="codellama", system_message=system_message, context=True)
-    client = GPTClient(model="gpt-4o", system_message=system_message, context=True)
+    system_message = SYSTEM_MESSAGE
+    cache = ResponseCache()
+    metrics = Metrics(log_path=None)  # e.g. Path('metrics.jsonl') to keep metrics for offline analysis
+    # client class and default model of backends, also used by "session <name> [backend:model]"
+    backends = {'openai': (GPTClient, 'gpt-4o'), 'ollama': (OllamaClient, 'codellama')}
+    client_class, default_model = backends['ollama' if args.ollama else 'openai']
+    client = client_class(model=args.model or default_model, system_message=system_message, context=True, cache=cache, metrics=metrics)
+
+    # models asked at once with "fanout <question>", each keeps its own conversation
+    fanout_models = [(GPTClient, "gpt-4o"), (OllamaClient, "codellama")]
+    fanout_clients = []
+    client.warm_up()  # while user is typing first question
+
+    # named sessions, "session <name> [backend:model]" creates or switches, "&<question>" asks in background
+    def new_client(spec):
+        """client for 'model' or 'backend:model' (e.g. ollama:codellama), of current backend by default"""
+        backend, _, model = spec.partition(':')
+        if backend in backends:
+            client_class, default_model = backends[backend]
+        else:
+            client_class, default_model, model = type(client), client.model, spec
+        new = client_class(model=model or default_model, system_message=system_message, context=True, cache=cache, store=client.store, metrics=metrics)
+        if isinstance(new, GPTClient) and isinstance(client, GPTClient):
+            new._client = client.client  # share connections pool
+        new.warm_up()
+        return new
+
+    def show_ready():
+        """answers which came in background to current session"""
+        ready = sessions.take_ready()
+        if not ready and sessions.current.busy:
+            print(f'[*] session [cyan]{sessions.current.name}[/cyan] is waiting for answer')
+        for asked, answer, error in ready:
+            print(f'[*] [cyan]{sessions.current.name}[/cyan] answer to: {asked}')
+            if error:
+                print(f'[red]\\[x] {error}[/red]')
+            else:
+                pretty_print_answer(answer)
+
+    # **** batch ****
+    if args.batch:
+        from batch import run_batch
+        if args.no_cache:
+            client.cache = None
+        run_batch(client, args.batch, args.output, args.workers, args.retries, not args.completion_order)
+        cache.close()
+        metrics.close()
+        sys.exit()
 
     # **** ollama chat ****
+    from sessions import Sessions
+    sessions = Sessions(client)
     while True:
+        session_name = f' ({sessions.current.name})' if len(sessions.sessions) > 1 else ''
         try:
-            question = input(f'{Color.CYAN}[*] you: {Color.RESET}')
+            question = sessions.input(f'{Color.CYAN}[*] you{session_name}: {Color.RESET}')
         except KeyboardInterrupt:
             print()
             continue
@@ -398,12 +1295,60 @@ if __name__ == "__main__":
             print()
             break
 
+        elif question == 'sessions':
+            sessions.show()
+            continue
+
+        elif question.startswith('session '):
+            name, _, spec = question.removeprefix('session ').strip().partition(' ')
+            if name not in sessions:
+                sessions.add(name, new_client(spec.strip()))
+                print(f'[*] new session [cyan]{name}[/cyan], model: [cyan]{sessions.sessions[name].client.model}[/cyan]')
+            client = sessions.switch(name).client
+            show_ready()
+            continue
+
+        elif question == 'show':
+            show_ready()
+            continue
+
+        elif sessions.current.busy and question not in READONLY_COMMANDS and not question.startswith('fanout'):
+            # conversation is changed when answer comes
+            print(f'[*] session [cyan]{sessions.current.name}[/cyan] is waiting for answer, switch to another one with "session <name>"')
+            continue
+
         elif question == "context":
             client.switch_context()
             continue
 
+        elif question == "stream":
+            client.switch_stream()
+            continue
+
+        elif question == "retrieval":
+            client.switch_retrieval()
+            continue
+
+        elif question == "tokens":
+            client.show_tokens()
+            continue
+
+        elif question == "stats":
+            client.show_stats()
+            continue
+
+        elif question == "cache":
+            client.show_cache()
+            continue
+
+        elif question == "cache clear":
+            if client.cache is not None:
+                client.cache.clear()
+            print('[*] cache cleared')
+            continue
+
         elif question == "talk":
-            print(client.messages)
+            show_talk(client.messages)
             continue
 
         elif question == "id":
@@ -422,13 +1367,78 @@ if __name__ == "__main__":
             client.get_model()
             continue
 
+        elif question.startswith('model '):
+            client.switch_model(question.removeprefix('model ').strip())
+            continue
+
         elif question == 'load':
             client.load_conversation()
             continue
 
+        elif question.startswith('search '):
+            client.search(question.removeprefix('search ').strip())
+            continue
+
+        elif question == 'compact':
+            # logs are rewritten, answers in flight would be appended to replaced files
+            waiting = [session.name for session in sessions if session.busy]
+            if waiting:
+                print(f"[*] sessions waiting for answers: {', '.join(waiting)}, compact when they're done")
+                continue
+            client.save_conversation()
+            for path in client.store.conversations():
+                client.store.compact(path)
+            print('[*] conversations compacted')
+            continue
+
+        elif question == 'fanout' or question.startswith('fanout '):
+            question = question.removeprefix('fanout').strip()
+            if not question:
+                print(f"[*] fanout models: {', '.join(model for _, model in fanout_models)}")
+                continue
+            from fanout import fan_out, show_summary
+            if not fanout_clients:
+                fanout_clients = [
+                    client_class(model=model, system_message=system_message, context=True, cache=cache, store=client.store, metrics=metrics)
+                    for client_class, model in fanout_models
+                ]
+                for fanout_client in fanout_clients:
+                    if isinstance(fanout_client, GPTClient) and isinstance(client, GPTClient):
+                        fanout_client._client = client.client  # share connections pool
+            use_cache = not (question.startswith('!') or args.no_cache)
+            answers = fan_out(fanout_clients, question.removeprefix('!').strip(), use_cache)
+            for answer in answers:
+                print(f'[*] [cyan]{answer.client.model}[/cyan] ({answer.describe()}):')
+                if answer.error:
+                    print(f'[red]\[x] {answer.error}[/red]')
+                else:
+                    pretty_print_answer(answer.text)
+            show_summary(answers)
+            continue
+
         # **** ask chat ****
-        answer = client.ask(question)
-        pretty_print_answer(answer)
+        background = question.startswith('&')
+        question = question.removeprefix('&').strip()
+        use_cache = not (question.startswith('!') or args.no_cache)
+        question = question.removeprefix('!').strip()
+        if background:
+            sessions.ask(question, use_cache)
+            print(f'[*] asked in background, session [cyan]{sessions.current.name}[/cyan]')
+        elif client.stream:
+            pretty_print_stream(client.ask_stream(question, use_cache=use_cache), client.metrics)
+        else:
+            answer = client.ask(question, use_cache=use_cache)
+            pretty_print_answer(answer, client.metrics)
+        if not background and client.messages[-1].get('truncated'):
+            print('[*] answer truncated')
 
-    # **** save last conversation ****
-    client.save_conversation()
+    # **** save last conversations ****
+    sessions.close()
+    for session in sessions:
+        session.client.save_conversation()
+        if session.client.retrieval is not None:
+            session.client.retrieval.close()
+    for fanout_client in fanout_clients:
+        fanout_client.save_conversation()
+    cache.close()
+    metrics.close()
@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from pathlib import Path
+
+import rich
+from rich import print
+
+from cache import ResponseCache
+from chat import SYSTEM_MESSAGE, GPTClient, OllamaClient, pretty_print_answer, pretty_print_stream, show_talk
+from metrics import Metrics
+from store import ConversationStore
+
+SOCKET_PATH = Path('cache') / 'daemon.sock'
+
+# commands answered by client methods, the rest is asked
+COMMANDS = {
+    'context': 'switch_context',
+    'stream': 'switch_stream',
+    'tokens': 'show_tokens',
+    'stats': 'show_stats',
+    'cache': 'show_cache',
+    'model': 'get_model',
+    'models': 'get_models',
+    'help': 'usage',
+}
+LOCAL_COMMANDS = ('load', 'search', 'compact', 'fanout', 'retrieval', 'session', 'sessions')  # need terminal or whole store, available in chat.py
+
+
+class SessionOutput:
+    """sys.stdout replacement, sending output of session threads to their frontends.
+
+    Everything in chat.py prints to stdout (directly or through rich), so with this
+    in place sessions don't need their own printing code and can't mix their output.
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    @property
+    def send(self):
+        return getattr(self.local, 'send', None)
+
+    def write(self, text):
+        if self.send is None:
+            return self.stdout.write(text)
+        if text:
+            self.send({'output': text})
+        return len(text)
+
+    def flush(self):
+        if self.send is None:
+            self.stdout.flush()
+
+    def isatty(self):
+        return True
+
+    @property
+    def encoding(self):
+        return 'utf-8'
+
+
+class SessionHandler(socketserver.StreamRequestHandler):
+    """Single frontend connection, with its own client (conversation)"""
+    def handle(self):
+        daemon = self.server.chat
+        client = daemon.new_client()
+        daemon.output.local.send = self.send
+        # inputs are read by another thread, so cancel arrives while answer is streamed
+        self.inputs = queue.Queue()
+        self.cancelled = threading.Event()
+        threading.Thread(target=self.read, daemon=True).start()
+        try:
+            for question in iter(self.inputs.get, None):
+                if question in ('exit', 'quit'):
+                    break
+                self.cancelled.clear()
+                try:
+                    daemon.run(client, question, self.cancelled)
+                except (BrokenPipeError, ConnectionResetError):
+                    raise
+                except Exception as err:
+                    print(f'[red]\\[x] {type(err).__name__}: {err}[/red]')
+                self.send({'done': True})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            daemon.output.local.send = None
+            daemon.close_client(client)
+
+    def read(self):
+        """put frontend inputs into queue, set cancelled on cancel message, None at the end"""
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                    if message.get('cancel'):
+                        self.cancelled.set()
+                        continue
+                    self.inputs.put(message.get('input', '').strip())
+                except (json.JSONDecodeError, AttributeError):
+                    continue
+        except (OSError, ValueError):
+            # connection closed by handler
+            pass
+        finally:
+            self.inputs.put(None)
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+
+
+class ChatServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ChatDaemon:
+    """Keeps clients, connections pool, responses cache, metrics and conversations store
+    warm, serving any number of frontends at once, each one from its own thread.
+    """
+    def __init__(self, model, ollama=False):
+        self.model = model
+        self.client_class = OllamaClient if ollama else GPTClient
+        self.cache = ResponseCache()
+        self.metrics = Metrics()
+        self.store = ConversationStore()
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.shared = self.new_client()  # its openai client (and connections pool) is shared by sessions
+        self.output = SessionOutput(sys.stdout)
+
+    def new_client(self):
+        client = self.client_class(model=self.model, system_message=SYSTEM_MESSAGE, cache=self.cache, store=self.store, metrics=self.metrics)
+        if isinstance(client, GPTClient) and self.clients:
+            client._client = self.shared.client
+        with self.lock:
+            self.clients.add(client)
+        return client
+
+    def close_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+        client.save_conversation()
+
+    def run(self, client, question, cancelled=None):
+        """handle single frontend input, like chat.py main loop does
+
+        Setting cancelled stops streamed answer, like Ctrl+C does in chat.py, answers
+        that are not streamed can't be cancelled.
+        """
+        if not question:
+            return
+        if question in COMMANDS:
+            getattr(client, COMMANDS[question])()
+        elif question == 'cache clear':
+            self.cache.clear()
+            print('[*] cache cleared')
+        elif question == 'talk':
+            # frontend has no pager, newest turns only
+            show_talk(client.messages, interactive=False)
+        elif question == 'id':
+            print(f'[*] conversation ID: [cyan]{client.conversation_id}[/cyan]')
+        elif question.startswith('model '):
+            client.switch_model(question.removeprefix('model ').strip())
+        elif question.split(' ', maxsplit=1)[0] in LOCAL_COMMANDS:
+            print(f'[*] {question.split()[0]} is available in chat.py only')
+        else:
+            use_cache = not question.startswith('!')
+            question = question.removeprefix('!').strip()
+            if client.stream:
+                pretty_print_stream(client.ask_stream(question, use_cache=use_cache, cancelled=cancelled), client.metrics)
+            else:
+                pretty_print_answer(client.ask(question, use_cache=use_cache), client.metrics)
+
+    def serve(self, path):
+        if path.exists():
+            if is_listening(path):
+                print(f'[red]\\[x] daemon already running: {path}[/red]')
+                return
+            path.unlink()  # left by daemon that was killed
+        path.parent.mkdir(exist_ok=True)
+        server = ChatServer(str(path), SessionHandler)
+        server.chat = self
+        os.chmod(path, 0o600)
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+        sys.stdout = self.output
+        print(f'[*] chat daemon listening on: [cyan]{path}[/cyan]')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            path.unlink(missing_ok=True)
+            for client in list(self.clients):
+                self.close_client(client)
+            self.cache.close()
+            self.metrics.close()
+            sys.stdout = self.output.stdout
+
+
+def is_listening(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except OSError:
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    os.chdir(str(Path(__file__).parent))
+    parser = argparse.ArgumentParser(description="Chat daemon serving frontend.py terminals over unix socket")
+    parser.add_argument("--model", default="gpt-4o", help="Model of sessions clients")
+    parser.add_argument("--ollama", action='store_true', help="Use Ollama instead of OpenAI")
+    args = parser.parse_args()
+    # frontends are terminals, even if daemon itself runs in background
+    rich.reconfigure(force_terminal=True)
+    daemon = ChatDaemon(args.model, args.ollama)
+    daemon.shared.warm_up()
+    daemon.serve(SOCKET_PATH)
@@ -0,0 +1,125 @@
+import threading
+import time
+
+from rich import print
+
+# rich renderables are slow to import, so they are imported on first use
+
+
+class Answer:
+    """Answer of single model, filled by its thread while it streams"""
+    def __init__(self, client):
+        self.client = client
+        self.chunks = []
+        self.start = None
+        self.first = None
+        self.end = None
+        self.error = None
+        self.cancelled = threading.Event()
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    def timings(self):
+        """time to first token, total time and tokens per second, None when not known yet"""
+        if self.start is None or self.first is None:
+            return None, None, None
+        now = self.end or time.perf_counter()
+        tokens = len(self.chunks)
+        metrics = self.client.metrics
+        if self.end and metrics and metrics.turns.get(self.client.model):
+            # usage reported by backend is more accurate than number of chunks
+            tokens = metrics.turns[self.client.model][-1].get('completion_tokens') or tokens
+        generation = now - self.first
+        rate = tokens / generation if generation > 0 else None
+        return self.first - self.start, now - self.start, rate
+
+    def describe(self):
+        if self.start is None:
+            return 'waiting'
+        ttft, total, rate = self.timings()
+        if ttft is None:
+            return f'waiting {time.perf_counter() - self.start:.1f}s'
+        return f'ttft {ttft:.2f}s, total {total:.2f}s' + (f', {rate:.1f} tok/s' if rate else '')
+
+    def run(self, question, use_cache):
+        self.start = time.perf_counter()
+        # cancelled ends waiting for chunks at once, e.g. while ollama loads the model
+        stream = self.client.ask_stream(question, use_cache=use_cache, cancelled=self.cancelled)
+        try:
+            for chunk in stream:
+                if self.first is None:
+                    self.first = time.perf_counter()
+                self.chunks.append(chunk)
+                if self.cancelled.is_set():
+                    break
+        except Exception as err:
+            self.error = f'{type(err).__name__}: {err}'
+        finally:
+            # partial answer is kept as truncated one
+            stream.close()
+        self.end = time.perf_counter()
+
+
+def render(answers, height):
+    """panels side by side, showing tail of every answer"""
+    from rich.columns import Columns
+    from rich.panel import Panel
+    from rich.text import Text
+    panels = []
+    for answer in answers:
+        if answer.error:
+            body = Text(answer.error, style='red')
+        else:
+            body = Text('\n'.join(answer.text.split('\n')[-height:]), style='yellow')
+        style = 'red' if answer.error else 'green' if answer.end else 'yellow'
+        subtitle = f'[{style}]{answer.describe()}[/{style}]'
+        panels.append(Panel(body, title=f'[cyan]{answer.client.model}[/cyan]', subtitle=subtitle, height=height + 2))
+    return Columns(panels, equal=True, expand=True)
+
+
+def fan_out(clients, question, use_cache=True):
+    """ask all clients at once, each answer streams into its own panel, return finished answers
+
+    Every model is asked from its own thread, so it takes as long as the slowest one.
+    Panels show only last lines of answers, so redrawing them costs the same all the time.
+    """
+    from rich.console import Console
+    from rich.live import Live
+    console = Console()
+    height = max(5, console.size.height // 2)
+    answers = [Answer(client) for client in clients]
+    threads = [threading.Thread(target=answer.run, args=(question, use_cache), daemon=True) for answer in answers]
+    for thread in threads:
+        thread.start()
+    with Live(render(answers, height), console=console, refresh_per_second=10, transient=True) as live:
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(0.1)
+                live.update(render(answers, height))
+        except KeyboardInterrupt:
+            for answer in answers:
+                answer.cancelled.set()
+            for thread in threads:
+                thread.join()
+    return answers
+
+
+def show_summary(answers):
+    """latency and token rate of models side by side"""
+    from rich.table import Table
+    table = Table(title='fanout')
+    for header in ('model', 'ttft', 'total', 'tok/s', 'status'):
+        table.add_column(header, justify='left' if header in ('model', 'status') else 'right')
+    for answer in answers:
+        ttft, total, rate = answer.timings()
+        status = f'[red]{answer.error}[/red]' if answer.error else '[green]ok[/green]'
+        cells = [f'{value:.2f}s' if value is not None else '-' for value in (ttft, total)]
+        table.add_row(answer.client.model, *cells, f'{rate:.1f}' if rate else '-', status)
+    print(table)
+    finished = [answer for answer in answers if answer.end]
+    if finished:
+        wall = max(answer.end for answer in finished) - min(answer.start for answer in finished)
+        total = sum(answer.end - answer.start for answer in finished)
+        print(f'[*] wall time: {wall:.2f}s, sum of model times: {total:.2f}s')
@@ -0,0 +1,104 @@
+# thin terminal frontend of daemon.py, imports nothing heavy so it starts in tens of milliseconds
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    # to support linux terminal
+    import readline
+except:
+    pass
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SOCKET_PATH = os.path.join(DIRECTORY, 'cache', 'daemon.sock')
+PROMPT = '\u001b[36m[*] you: \u001b[0m'
+
+
+def start_daemon(timeout=30):
+    """start daemon in background and wait for its socket"""
+    columns = str(os.get_terminal_size().columns) if sys.stdout.isatty() else '80'
+    subprocess.Popen(
+        [sys.executable, os.path.join(DIRECTORY, 'daemon.py')] + sys.argv[1:],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+        env=dict(os.environ, COLUMNS=columns),
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return connect()
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'daemon did not start in {timeout}s')
+
+
+def connect():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def send(sock, text):
+    sock.sendall(json.dumps({'input': text}).encode('utf-8') + b'\n')
+
+
+def cancel(sock):
+    """stop answer being streamed, daemon keeps its part and still replies done"""
+    sock.sendall(json.dumps({'cancel': True}).encode('utf-8') + b'\n')
+
+
+def print_replies(sock, replies):
+    """print daemon output until it's done with input, False if daemon closed connection"""
+    while True:
+        try:
+            for line in replies:
+                reply = json.loads(line)
+                if reply.get('done'):
+                    return True
+                sys.stdout.write(reply.get('output', ''))
+                sys.stdout.flush()
+            return False
+        except KeyboardInterrupt:
+            cancel(sock)
+
+
+def main():
+    try:
+        sock = connect()
+    except OSError:
+        print('[*] starting chat daemon')
+        sock = start_daemon()
+    replies = sock.makefile('r', encoding='utf-8')
+    while True:
+        try:
+            question = input(PROMPT).strip()
+        except KeyboardInterrupt:
+            print()
+            continue
+        except EOFError:
+            question = 'exit'
+        if not question:
+            continue
+        if question in ('cls', 'clear'):
+            os.system('cls' if os.name == 'nt' else 'clear')
+            continue
+        send(sock, question)
+        if question in ('exit', 'quit'):
+            break
+        if not print_replies(sock, replies):
+            print('[x] daemon closed connection')
+            break
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
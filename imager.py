@@ -1,27 +1,122 @@
 import argparse
+import base64
+import binascii
 import os
 import re
 import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 from string import ascii_letters, digits
 
-import requests
-from dotenv import dotenv_values
-from openai import BadRequestError, OpenAI
 from rich import print
-from rich.prompt import Prompt
 from unidecode import unidecode
 
+# requests, openai and rich prompt are slow to import, so they are imported when needed
 
-def save_img_from_url(url, path):
+
+class RateLimiter:
+    """Spreads requests evenly in time, to stay within requests per minute limit"""
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute if per_minute else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self, stop=None):
+        """wait for turn of next request, setting stop ends waiting early"""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if stop is None:
+            time.sleep(start - now)
+        else:
+            stop.wait(start - now)
+
+
+def create_session(pool_size):
+    """requests session with connections pool shared between threads"""
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def write_atomic(path, chunks):
+    """write chunks of bytes to temporary file and move it to path, so partial files never show up"""
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def decode_b64_chunks(data, chunk_size=64*1024):
+    """decode base64 string piece by piece, chunk_size has to be multiple of 4"""
+    for index in range(0, len(data), chunk_size):
+        yield base64.b64decode(data[index:index+chunk_size])
+
+
+def save_img_from_b64(data, path):
+    """save base64 encoded image, to specified local path"""
+    write_atomic(path, decode_b64_chunks(data))
+    return True
+
+
+def save_img_from_url(url, path, session=None, retries=3, timeout=(10, 60)):
     """save image from specified url, to specified local path"""
-    response = requests.get(url)
-    if response.status_code != 200:
+    import requests
+    session = session or requests
+    for attempt in range(retries+1):
+        if attempt:
+            time.sleep(2 ** attempt)
+        try:
+            with session.get(url, stream=True, timeout=timeout) as response:
+                if response.status_code >= 500:
+                    continue
+                elif response.status_code != 200:
+                    return False
+                write_atomic(path, response.iter_content(chunk_size=64*1024))
+                return True
+        except requests.RequestException as err:
+            print(f'[yellow]{err}[/yellow]')
+    return False
+
+
+def generate_and_save(index, client, session, limiter, stop, directory, name_prefix, padding, **query):
+    """generate single image and save it to directory, as soon as it is ready"""
+    if stop.is_set():
+        return None
+    limiter.wait(stop)
+    if stop.is_set():
+        return None
+    response = client.images.generate(n=1, **query)  # You must provide n=1 for dall-e-3 model
+    if stop.is_set():
+        # request already running can't be cancelled, but its image is not saved after stop
+        return None
+    image = response.data[0]
+    now = time.strftime('%H%M%S')
+    filename = f'{name_prefix}-{now}-{index:0{padding}}.png'
+    filepath = directory.joinpath(filename)
+    if image.b64_json:
+        saved = save_img_from_b64(image.b64_json, filepath)
+    else:
+        saved = save_img_from_url(image.url, filepath, session)
+    if not saved:
         return False
-    with open(path, 'wb') as f:
-        f.write(response.content)
-    return True
+    return filepath
 
 
 def sanitize_name(name):
@@ -41,11 +136,6 @@ def sanitize_name(name):
 if __name__ == "__main__":
     os.chdir(str(Path(__file__).parent))
 
-    # **** load config ****
-    config = dotenv_values()
-    OPENAI_API_KEY = config["OPENAI-API-KEY"]
-    client = OpenAI(api_key=OPENAI_API_KEY)
-
     # **** args ****
     parser = argparse.ArgumentParser()
     parser.add_argument("prompt", help="Text prompt to generate image")
@@ -53,10 +143,14 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--number", required=False, default=1, type=int, help="Number of images to generate")
     parser.add_argument("--skip", required=False, action='store_true', help="If error occur skip and go next")
     parser.add_argument("--style", default="vivid", choices=["vivid", "natural"])
+    parser.add_argument("--format", default="b64_json", choices=["b64_json", "url"], help="Get image data within response, or download it from url")
+    parser.add_argument("-c", "--concurrency", default=1, type=int, help="Number of images generated in parallel")
+    parser.add_argument("--rpm", default=0, type=float, help="Rate limit, requests per minute (0 for no limit)")
     args = parser.parse_args()
     PROMPT = args.prompt
     NUMBER = args.number
     if NUMBER > 10:
+        from rich.prompt import Prompt
         response = Prompt.ask('[yellow bold][>] do you really want to generate more than 10 images? (yes/No)[/yellow bold]')
         if not response.lower() in ('yes', 'y'):
             sys.exit()
@@ -73,13 +167,20 @@ if __name__ == "__main__":
         # natural causes the model to produce more natural, less hyper-real looking images
         STYLE = 'vivid'
 
+    # **** load config ****
+    from dotenv import dotenv_values
+    from openai import APIError, OpenAI
+    config = dotenv_values()
+    OPENAI_API_KEY = config.get("OPENAI-API-KEY")  # OPENAI_API_KEY and OPENAI_BASE_URL env variables work too
+    client = OpenAI(api_key=OPENAI_API_KEY, max_retries=5)  # retries backs off on rate limit responses
+
     # **** query setup ****
     # https://openai.com/api/pricing/
     # DALL·E 3 Standard 1024×1024 $0.040 / image
     model = "dall-e-3"
     size = "1024x1024"
     quality = "standard"
-    print(f'[*] query setup: {model=} {size=} {quality=}')
+    print(f'[*] query setup: {model=} {size=} {quality=} format={args.format!r}')
     print(f'[*] prompt: [cyan bold]{PROMPT}[/cyan bold]')
     print(f'[*] it will cost you: {NUMBER} * {0.040}$ => {NUMBER * 0.040}$')
 
@@ -87,32 +188,54 @@ if __name__ == "__main__":
     padding = len(str(NUMBER))
     directory = Path('dalle')
     directory.mkdir(exist_ok=True)
-    for index in range(1, NUMBER+1):
-        print(f'{index}/{NUMBER})')
-        try:
-            # **** query for image ****
-            response = client.images.generate(
-                model=model,
-                prompt=PROMPT,
-                size=size,
-                style=STYLE,
-                quality=quality,
-                n=1,  # You must provide n=1 for this model
-            )
-            url = response.data[0].url
-        except BadRequestError as err:
-            print(f'[red]{err}[/red]')
-            if SKIP:
+    CONCURRENCY = max(1, min(args.concurrency, NUMBER))
+    session = create_session(CONCURRENCY)
+    limiter = RateLimiter(args.rpm)
+    stop = threading.Event()
+    task = partial(
+        generate_and_save,
+        client=client,
+        session=session,
+        limiter=limiter,
+        stop=stop,
+        directory=directory,
+        name_prefix=name_prefix,
+        padding=padding,
+        model=model,
+        prompt=PROMPT,
+        size=size,
+        style=STYLE,
+        quality=quality,
+        response_format=args.format,
+    )
+    executor = ThreadPoolExecutor(max_workers=CONCURRENCY)
+    futures = {executor.submit(task, index): index for index in range(1, NUMBER+1)}
+    try:
+        for done, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            try:
+                filepath = future.result()
+            except (APIError, OSError, binascii.Error) as err:
+                # request failed after retries, image couldn't be written, or its data is corrupted
+                print(f'{index}/{NUMBER}) [red]{type(err).__name__}: {err}[/red]')
+                if SKIP:
+                    continue
+                else:
+                    stop.set()
+                    break
+            if filepath is None:
+                continue
+            elif not filepath:
+                print(f'{index}/{NUMBER}) [red]failed to download image[/red]')
                 continue
-            else:
-                break
-        except KeyboardInterrupt:
-            print(f'\n[yellow bold][*] broken by user[/yellow bold]')
-            break
-
-        # **** save images to disk ****
-        now = time.strftime('%H%M%S')
-        filename = f'{name_prefix}-{now}-{index:0{padding}}.png'
-        filepath = directory.joinpath(filename)
-        save_img_from_url(url, filepath)
-        print(f'[*] image saved to: [magenta bold]{filepath}[/magenta bold]')
+
+            # **** image saved to disk ****
+            print(f'{index}/{NUMBER}) [*] image saved to: [magenta bold]{filepath}[/magenta bold]')
+    except KeyboardInterrupt:
+        stop.set()
+        print(f'\n[yellow bold][*] broken by user[/yellow bold]')
+    executor.shutdown(wait=False, cancel_futures=True)
+    running = sum(future.running() for future in futures)
+    if running:
+        # python waits for executor threads before exit
+        print(f"[yellow][*] waiting for {running} requests in progress, sent ones can't be cancelled, their images won't be saved[/yellow]")
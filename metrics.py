@@ -0,0 +1,231 @@
+import json
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+
+from rich import print
+
+# fields summarized by percentiles: (name, header, format)
+SUMMARY_FIELDS = [
+    ('ttft', 'ttft', '{:.2f}s'),
+    ('network', 'network', '{:.2f}s'),
+    ('tokens_per_second', 'tok/s', '{:.1f}'),
+    ('prompt_tokens', 'prompt', '{:.0f}'),
+    ('cached_tokens', 'cached', '{:.0f}'),
+    ('completion_tokens', 'completion', '{:.0f}'),
+    ('payload_bytes', 'payload', '{:.0f}B'),
+    ('render', 'render', '{:.3f}s'),
+]
+
+# USD per 1M tokens: (prompt, cached prompt, completion), matched by longest model name prefix
+PRICES = {
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4.1': (2.00, 0.50, 8.00),
+    'gpt-4.1-mini': (0.40, 0.10, 1.60),
+    'gpt-4.1-nano': (0.10, 0.025, 0.40),
+    'o3-mini': (1.10, 0.55, 4.40),
+}
+
+
+class Turn:
+    """Timings and token counts of single request"""
+    def __init__(self, model, backend, messages):
+        self.data = {
+            'time': time.time(),
+            'model': model,
+            'backend': backend,
+            'payload_bytes': len(json.dumps(messages, ensure_ascii=False).encode('utf-8')),
+        }
+        self.start = time.perf_counter()
+        self.first = None
+
+    def token(self):
+        """mark arrival of answer token, first one gives time to first token"""
+        if self.first is None:
+            self.first = time.perf_counter()
+
+    def finish(self, **fields):
+        end = time.perf_counter()
+        self.data.update(fields)
+        self.data['network'] = end - self.start
+        first = self.first or end
+        self.data['ttft'] = first - self.start
+        completion = self.data.get('completion_tokens')
+        generation = end - first if self.first else end - self.start
+        if completion and generation > 0:
+            self.data['tokens_per_second'] = completion / generation
+        return self.data
+
+
+class Metrics:
+    """Rolling in-memory summary of turns per model, with optional jsonl log.
+
+    Last turn is written to the log when next one is recorded (or on close),
+    so render time measured after request can still be added with update().
+    """
+    def __init__(self, log_path=None, window=1000):
+        self.turns = defaultdict(lambda: deque(maxlen=window))  # model -> turns
+        self.log_path = Path(log_path) if log_path else None
+        self.last = None
+        self.totals = defaultdict(int)  # token counts of all turns, not only those in window
+        self.lock = threading.Lock()  # turns may be recorded from many threads, e.g. in batch mode
+
+    def start(self, model, backend, messages):
+        return Turn(model, backend, messages)
+
+    def record(self, turn):
+        with self.lock:
+            self._flush()
+            self.turns[turn['model']].append(turn)
+            self.last = turn
+            for field in ('prompt_tokens', 'cached_tokens', 'completion_tokens'):
+                self.totals[field] += turn.get(field) or 0
+
+    def update(self, **fields):
+        """add fields to last turn, e.g. render time"""
+        with self.lock:
+            if self.last is not None:
+                self.last.update(fields)
+
+    def close(self):
+        with self.lock:
+            self._flush()
+
+    def summary(self):
+        """p50/p95 of fields per model"""
+        with self.lock:
+            # copied, so turns recorded meanwhile by other threads don't break iteration
+            models = {model: list(turns) for model, turns in self.turns.items()}
+        result = {}
+        for model, turns in models.items():
+            requests = [turn for turn in turns if not turn.get('cache_hit')]
+            stats = {'turns': len(turns), 'cache_hits': len(turns) - len(requests)}
+            for field, _, _ in SUMMARY_FIELDS:
+                values = sorted(turn[field] for turn in requests if turn.get(field) is not None)
+                stats[field] = (percentile(values, 50), percentile(values, 95))
+            result[model] = stats
+        return result
+
+    def show(self):
+        from rich.table import Table
+        summary = self.summary()
+        if not summary:
+            print('[*] no stats yet')
+            return
+        table = Table(title='per turn stats, p50 / p95')
+        table.add_column('')
+        for model in summary:
+            table.add_column(model, justify='right')
+        table.add_row('turns', *[f"{stats['turns']} ({stats['cache_hits']} cached)" for stats in summary.values()])
+        for field, header, fmt in SUMMARY_FIELDS:
+            table.add_row(header, *[format_pair(stats[field], fmt) for stats in summary.values()])
+        print(table)
+        if self.log_path:
+            print(f'[*] metrics log: [cyan]{self.log_path}[/cyan]')
+
+    def _flush(self):
+        if self.log_path is None or self.last is None:
+            return
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.last) + '\n')
+        self.last = None
+
+
+class ConversationUsage:
+    """Token counts of single conversation, with savings made by provider's prompt caching.
+
+    Cached prompt tokens are cheaper and skip prefill, so time to first token of turns
+    with cache hits is compared with turns without them.
+    """
+    def __init__(self, saved=None):
+        saved = saved or {}
+        self.turns = saved.get('turns', 0)
+        self.prompt_tokens = saved.get('prompt_tokens', 0)
+        self.cached_tokens = saved.get('cached_tokens', 0)
+        self.completion_tokens = saved.get('completion_tokens', 0)
+        self.added = 0  # turns added since loaded
+        self.ttft = {True: [], False: []}  # cache hit -> ttft of turns, this session only
+        self.lock = threading.Lock()
+
+    def add(self, usage, ttft=None):
+        """usage is dict of token counts, like from openai_usage or ollama_usage"""
+        with self.lock:
+            self.turns += 1
+            self.added += 1
+            self.prompt_tokens += usage.get('prompt_tokens') or 0
+            self.cached_tokens += usage.get('cached_tokens') or 0
+            self.completion_tokens += usage.get('completion_tokens') or 0
+            if ttft is not None:
+                self.ttft[bool(usage.get('cached_tokens'))].append(ttft)
+
+    def cost(self, model):
+        """(cost, saved by cache) in USD, None if price of model is not known"""
+        prices = model_prices(model)
+        if prices is None:
+            return None, None
+        prompt, cached, completion = (price / 1e6 for price in prices)
+        cost = (self.prompt_tokens - self.cached_tokens) * prompt + self.cached_tokens * cached + self.completion_tokens * completion
+        return cost, self.cached_tokens * (prompt - cached)
+
+    def summary(self, model):
+        """totals saved with conversation metadata"""
+        cost, saved = self.cost(model)
+        summary = {
+            'turns': self.turns,
+            'prompt_tokens': self.prompt_tokens,
+            'cached_tokens': self.cached_tokens,
+            'completion_tokens': self.completion_tokens,
+        }
+        if cost is not None:
+            summary['cost'] = round(cost, 6)
+            summary['cache_saved'] = round(saved, 6)
+        return summary
+
+    def describe(self, model):
+        share = self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0
+        text = f'{self.prompt_tokens} prompt tokens, {self.cached_tokens} cached ({share:.0%}), {self.completion_tokens} completion'
+        cost, saved = self.cost(model)
+        if cost is not None:
+            text += f', cost ${cost:.4f}, saved by cache ${saved:.4f}'
+        hits, misses = (percentile(sorted(self.ttft[key]), 50) for key in (True, False))
+        if hits is not None and misses is not None:
+            text += f', ttft p50 {hits:.2f}s with cache hit vs {misses:.2f}s without'
+        return text
+
+
+def model_prices(model):
+    matches = [name for name in PRICES if model.startswith(name)]
+    return PRICES[max(matches, key=len)] if matches else None
+
+
+def percentile(values, percent):
+    """nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def format_pair(pair, fmt):
+    return ' / '.join('-' if value is None else fmt.format(value) for value in pair)
+
+
+def openai_usage(usage):
+    """token counts from openai usage object"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'prompt_tokens': usage.prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        'cached_tokens': getattr(details, 'cached_tokens', None) or 0,
+    }
+
+
+def ollama_usage(response):
+    """token counts from final ollama response (chunk)"""
+    return {
+        'prompt_tokens': response.get('prompt_eval_count'),
+        'completion_tokens': response.get('eval_count'),
+    }
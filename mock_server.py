@@ -0,0 +1,227 @@
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rich import print
+
+ANSWER_TOKENS = [
+    'Here', ' is', ' the', ' answer', ':\n', '```', 'python', '\n',
+    'for', ' i', ' in', ' range', '(', '10', '):\n', '    print', '(', 'i', ')\n', '```', '\n',
+    'It', ' prints', ' numbers', ' from', ' 0', ' to', ' 9', '.', '\n',
+]
+
+
+def make_png(width=64, height=64):
+    """valid grayscale png, with a gradient so it isn't trivial to compress"""
+    def chunk(kind, data):
+        return len(data).to_bytes(4, 'big') + kind + data + zlib.crc32(kind + data).to_bytes(4, 'big')
+    rows = b''.join(b'\x00' + bytes((x + y) % 256 for x in range(width)) for y in range(height))
+    header = width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + bytes([8, 0, 0, 0, 0])
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+class MockConfig:
+    """Behaviour of mock server, can be changed while it is running"""
+    def __init__(self, latency=0.2, token_rate=50.0, answer_tokens=60, failure_rate=0.0, image_latency=0.5):
+        self.latency = latency  # seconds before first token
+        self.token_rate = token_rate  # tokens per second, 0 for no delay
+        self.answer_tokens = answer_tokens
+        self.failure_rate = failure_rate  # part of requests answered with 500/429
+        self.image_latency = image_latency
+        self.requests = 0
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Speaks the subset of OpenAI and Ollama APIs used by chat.py, ocr.py and imager.py"""
+    protocol_version = 'HTTP/1.1'
+    config = MockConfig()
+    image = make_png()
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        except (BrokenPipeError, ConnectionResetError):
+            # client cancelled request
+            self.close_connection = True
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/v1/models':
+            self.send_json({'object': 'list', 'data': [{'id': 'mock-gpt', 'object': 'model', 'created': 0, 'owned_by': 'mock'}]})
+        elif path == '/files/image.png':
+            self.send_body(self.image, 'image/png')
+        elif path == '/api/tags':
+            self.send_json({'models': [{'model': 'mock-llama:latest', 'size': 1024}]})
+        elif path == '/api/ps':
+            self.send_json({'models': [{'model': 'mock-llama:latest', 'size': 1024, 'size_vram': 1024}]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        self.config.requests += 1
+        if self.path.startswith('/v1/') and random.random() < self.config.failure_rate:
+            status = random.choice([429, 500])
+            self.send_json({'error': {'message': 'injected failure', 'type': 'mock', 'code': status}}, status)
+            return
+        if self.path == '/v1/chat/completions':
+            self.chat_completions(request)
+        elif self.path == '/v1/images/generations':
+            self.images_generations(request)
+        elif self.path == '/api/chat':
+            self.ollama_chat(request)
+        elif self.path in ('/api/embeddings', '/api/embed'):
+            self.ollama_embeddings(request)
+        elif self.path == '/api/generate':
+            self.send_json({'model': request.get('model'), 'response': '', 'done': True})
+        else:
+            self.send_error(404)
+
+    # **** responses ****
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode('utf-8'), 'application/json', status)
+
+    def start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+    def tokens(self):
+        """answer tokens, yielded with configured latency and rate"""
+        time.sleep(self.config.latency)
+        delay = 1 / self.config.token_rate if self.config.token_rate else 0
+        for index in range(self.config.answer_tokens):
+            if index and delay:
+                time.sleep(delay)
+            yield ANSWER_TOKENS[index % len(ANSWER_TOKENS)]
+
+    @staticmethod
+    def prompt_tokens(messages):
+        return sum(len(str(message.get('content', ''))) // 4 + 4 for message in messages if message)
+
+    # **** openai ****
+    def chat_completions(self, request):
+        model = request.get('model', 'mock-gpt')
+        prompt_tokens = self.prompt_tokens(request.get('messages', []))
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': self.config.answer_tokens,
+            'total_tokens': prompt_tokens + self.config.answer_tokens,
+            'prompt_tokens_details': {'cached_tokens': 0},
+        }
+        base = {'id': 'chatcmpl-mock', 'created': int(time.time()), 'model': model}
+        if not request.get('stream'):
+            content = ''.join(self.tokens())
+            message = {'role': 'assistant', 'content': content}
+            choice = {'index': 0, 'message': message, 'finish_reason': 'stop', 'logprobs': None}
+            self.send_json({**base, 'object': 'chat.completion', 'choices': [choice], 'usage': usage})
+            return
+        self.start_stream('text/event-stream')
+        for token in self.tokens():
+            choice = {'index': 0, 'delta': {'role': 'assistant', 'content': token}, 'finish_reason': None}
+            self.send_event({**base, 'object': 'chat.completion.chunk', 'choices': [choice]})
+        choice = {'index': 0, 'delta': {}, 'finish_reason': 'stop'}
+        self.send_event({**base, 'object': 'chat.completion.chunk', 'choices': [choice]})
+        if (request.get('stream_options') or {}).get('include_usage'):
+            self.send_event({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def send_event(self, data):
+        self.wfile.write(f'data: {json.dumps(data)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def images_generations(self, request):
+        time.sleep(self.config.image_latency)
+        if request.get('response_format') == 'b64_json':
+            item = {'b64_json': base64.b64encode(self.image).decode('ascii')}
+        else:
+            host = self.headers.get('Host')
+            item = {'url': f'http://{host}/files/image.png'}
+        self.send_json({'created': int(time.time()), 'data': [{**item, 'revised_prompt': request.get('prompt')}]})
+
+    # **** ollama ****
+    def ollama_chat(self, request):
+        model = request.get('model', 'mock-llama')
+        final = {
+            'model': model,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'done': True,
+            'done_reason': 'stop',
+            'prompt_eval_count': self.prompt_tokens(request.get('messages', [])),
+            'eval_count': self.config.answer_tokens,
+        }
+        if not request.get('stream', True):
+            content = ''.join(self.tokens())
+            self.send_json({**final, 'message': {'role': 'assistant', 'content': content}})
+            return
+        self.start_stream('application/x-ndjson')
+        for token in self.tokens():
+            line = {'model': model, 'created_at': final['created_at'], 'message': {'role': 'assistant', 'content': token}, 'done': False}
+            self.wfile.write(json.dumps(line).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        line = {**final, 'message': {'role': 'assistant', 'content': ''}}
+        self.wfile.write(json.dumps(line).encode('utf-8') + b'\n')
+
+    @staticmethod
+    def embedding(text):
+        """deterministic pseudo embedding, similar texts don't get similar vectors"""
+        rng = random.Random(hashlib.sha256(str(text).encode('utf-8')).digest())
+        return [rng.uniform(-1, 1) for _ in range(64)]
+
+    def ollama_embeddings(self, request):
+        if 'input' in request:
+            texts = request['input'] if isinstance(request['input'], list) else [request['input']]
+            self.send_json({'model': request.get('model'), 'embeddings': [self.embedding(text) for text in texts]})
+        else:
+            self.send_json({'embedding': self.embedding(request.get('prompt', ''))})
+
+
+def start_server(host='127.0.0.1', port=0, config=None):
+    """run mock server in background thread, return server and its base url"""
+    handler = type('Handler', (MockHandler,), {'config': config or MockConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for OpenAI and Ollama APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--latency", default=0.2, type=float, help="Seconds before first token")
+    parser.add_argument("--token-rate", default=50.0, type=float, help="Tokens per second (0 for no delay)")
+    parser.add_argument("--answer-tokens", default=60, type=int, help="Number of tokens in every answer")
+    parser.add_argument("--failure-rate", default=0.0, type=float, help="Part of OpenAI requests failing with 500/429")
+    parser.add_argument("--image-latency", default=0.5, type=float, help="Seconds to generate image")
+    args = parser.parse_args()
+    config = MockConfig(args.latency, args.token_rate, args.answer_tokens, args.failure_rate, args.image_latency)
+    server, url = start_server(args.host, args.port, config)
+    print(f'[*] mock server listening on: [cyan]{url}[/cyan]')
+    print(f'    OPENAI_BASE_URL={url}/v1 OPENAI_API_KEY=mock OLLAMA_HOST={url}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print()
+        server.shutdown()
@@ -1,48 +1,438 @@
+import argparse
 import base64
+import glob
+import hashlib
+import io
+import json
+import os
+import random
+import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from dotenv import dotenv_values
-from openai import OpenAI
 
-def encode_image(image_path):
+# openai and pillow are slow to import, so they are imported when needed
+# pdfs are rendered with pypdfium2 or PyMuPDF, whichever is installed
+
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.webp', '.gif'}
+PDF_SUFFIX = '.pdf'
+PDF_LOCK = threading.Lock()  # pdf libraries are not thread safe
+
+
+def encode_image(data):
     """Function to encode the image"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-# **** config ****
-config = dotenv_values()
-OPENAI_API_KEY = config["OPENAI-API-KEY"]
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-# **** read & encode image content ****
-args = sys.argv[1:]
-if not args:
-    print("usage:\n    python ocr.py image.png")
-    sys.exit()
-image_path = args[0]
-if not Path(image_path).exists():
-    raise Exception(f'no such file: {image_path}')
-base64_image = encode_image(image_path)
-
-# **** ask gpt ****
-response = client.chat.completions.create(
-    model="gpt-4o",
-    messages=[
-        {
-        "role": "user",
-        "content": [
-            {
-            "type": "text",
-            "text": "get text from image. Return it and nothing more",
-            },
+    return base64.b64encode(data).decode('utf-8')
+
+
+def detect_mime(data):
+    """detect image type from its magic bytes"""
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    elif data.startswith(b'GIF8'):
+        return 'image/gif'
+    elif data.startswith(b'RIFF') and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+
+def prepare_image(data, max_size=2048, grayscale=False, quality=85):
+    """downsize and recompress image before upload, return data and its mime type
+    max_size is limit for longer side, images above 2048px are scaled down by api anyway
+    data is content of image file, or pillow image (pdf page or tile of bigger image)
+    """
+    if isinstance(data, bytes):
+        mime = detect_mime(data)
+        try:
+            from PIL import Image, ImageOps
+        except ModuleNotFoundError:
+            # without pillow images are sent as they are
+            return data, mime
+        image = Image.open(io.BytesIO(data))
+    else:
+        # rendered or cropped, so there is no file to send as it is
+        from PIL import Image, ImageOps
+        image, data, mime = data, None, 'image/png'
+    with image:
+        image = ImageOps.exif_transpose(image)
+        resized = bool(max_size) and max(image.size) > max_size
+        if resized:
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+        if grayscale:
+            image = image.convert('L')
+        elif image.mode not in ('RGB', 'L'):
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.convert('RGBA'))
+            image = background
+        candidates = []
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        candidates.append((buffer.getvalue(), 'image/jpeg'))
+        if mime in ('image/png', 'image/gif'):
+            # screenshots and scans of text are often smaller and sharper as png
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG', optimize=True)
+            candidates.append((buffer.getvalue(), 'image/png'))
+    processed, processed_mime = min(candidates, key=lambda item: len(item[0]))
+    if data is not None and not (resized or grayscale) and len(processed) >= len(data):
+        return data, mime
+    return processed, processed_mime
+
+
+def render_pdf(path, dpi=200):
+    """yield pages of pdf as pillow images or png data, one by one"""
+    try:
+        import pypdfium2 as pdfium
+    except ModuleNotFoundError:
+        pdfium = None
+    if pdfium is not None:
+        with PDF_LOCK:
+            pdf = pdfium.PdfDocument(str(path))
+            count = len(pdf)
+        try:
+            for index in range(count):
+                with PDF_LOCK:
+                    # copy, so the image doesn't share memory with bitmap of closed document
+                    image = pdf[index].render(scale=dpi / 72).to_pil().copy()
+                yield image
+        finally:
+            with PDF_LOCK:
+                pdf.close()
+        return
+    try:
+        import fitz
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError('pdf needs pypdfium2 or PyMuPDF, `pip install pypdfium2`') from None
+    with PDF_LOCK:
+        pdf = fitz.open(str(path))
+    try:
+        for index in range(len(pdf)):
+            with PDF_LOCK:
+                data = pdf[index].get_pixmap(dpi=dpi).tobytes('png')
+            yield data
+    finally:
+        with PDF_LOCK:
+            pdf.close()
+
+
+def split_image(data, max_size=2048, tile_height=1536, overlap=192):
+    """yield tall or huge image split into overlapping horizontal bands, top to bottom
+
+    Image is scaled to max_size width, and split when it's still much taller than
+    tile_height, as api would scale it down as a whole, making text unreadable.
+    Bands span whole width, so lines are never cut in half sideways, and overlap
+    makes sure every line is whole in at least one band. Bands are yielded as
+    pillow images cropped from the original, they are scaled down and compressed
+    by prepare_image, in the pool along with requests.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ModuleNotFoundError:
+        yield data
+        return
+    image = Image.open(io.BytesIO(data)) if isinstance(data, bytes) else data
+    width, height = image.size
+    scale = min(1, max_size / width) if max_size else 1
+    if not tile_height or height * scale <= tile_height * 1.25:
+        yield data
+        return
+    image = ImageOps.exif_transpose(image)
+    image.load()
+    width, height = image.size
+    scale = min(1, max_size / width) if max_size else 1
+    band, step = round(tile_height / scale), round((tile_height - overlap) / scale)
+    # last band ends at the bottom, instead of being a thin strip
+    tops = list(range(0, height - band, step)) + [height - band]
+    for top in tops:
+        yield image.crop((0, top, width, top + band))
+
+
+def document_pieces(path, max_size=2048, tile_height=1536, overlap=192, dpi=200):
+    """yield (page, image) of pdf pages or image, split into tiles when needed"""
+    if Path(path).suffix.lower() == PDF_SUFFIX:
+        pages = render_pdf(path, dpi)
+    else:
+        pages = [Path(path).read_bytes()]
+    for page, data in enumerate(pages, start=1):
+        for tile in split_image(data, max_size, tile_height, overlap):
+            yield page, tile
+
+
+def normalize_line(line):
+    return re.sub(r'\s+', ' ', line).strip().lower()
+
+
+def merge_texts(texts, search_lines=30, min_overlap=2):
+    """join text of overlapping tiles, dropping lines repeated in overlap
+
+    Overlap is the longest run of lines ending upper tile and starting lower one, of at least
+    min_overlap non-blank lines. Single line on each side of it may be cut by tile edge, it's
+    read whole in the other tile, so it's dropped. Without such run texts are just joined, as
+    short lines (e.g. "}" or "return x") are repeated in text often.
+    """
+    merged = []
+    for text in texts:
+        lines = (text or '').strip('\n').split('\n')
+        if not merged:
+            merged = lines
+            continue
+        overlap = find_overlap(merged, lines, search_lines, min_overlap)
+        if overlap:
+            cut, start = overlap
+            merged = merged[:cut] + lines[start:]
+        else:
+            merged += lines
+    return '\n'.join(merged)
+
+
+def find_overlap(upper, lower, search_lines=30, min_overlap=2):
+    """(end of upper, start of lower) to join lines at, None when tiles don't overlap"""
+    # (index, line) of non-blank lines, as blank ones are not read the same way in both tiles
+    tail = [(index, normalize_line(line)) for index, line in enumerate(upper) if line.strip()][-search_lines:]
+    head = [(index, normalize_line(line)) for index, line in enumerate(lower) if line.strip()][:search_lines]
+    for size in range(min(len(tail), len(head)), min_overlap - 1, -1):
+        for cut_upper in (0, 1):
+            for cut_lower in (0, 1):
+                if size + cut_upper > len(tail) or size + cut_lower > len(head):
+                    continue
+                run = tail[len(tail) - cut_upper - size:len(tail) - cut_upper]
+                if [line for _, line in run] == [line for _, line in head[cut_lower:cut_lower + size]]:
+                    return run[-1][0] + 1, head[cut_lower + size - 1][0] + 1
+    return None
+
+
+def file_hash(path):
+    """sha256 of file content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_images(pattern):
+    """list images and pdfs from directory or glob pattern"""
+    if Path(pattern).is_dir():
+        paths = Path(pattern).rglob('*')
+    else:
+        paths = map(Path, glob.glob(pattern, recursive=True))
+    return sorted(path for path in paths if path.suffix.lower() in IMAGE_SUFFIXES | {PDF_SUFFIX} and path.is_file())
+
+
+def ocr_image(client, data, mime='image/jpeg'):
+    """ask gpt for text from image"""
+    base64_image = encode_image(data)
+    response = client.chat.completions.create(
+        model="gpt-4o",
+        messages=[
             {
-            "type": "image_url",
-            "image_url": {"url":  f"data:image/jpeg;base64,{base64_image}"},
-            },
+            "role": "user",
+            "content": [
+                {
+                "type": "text",
+                "text": "get text from image. Return it and nothing more",
+                },
+                {
+                "type": "image_url",
+                "image_url": {"url":  f"data:{mime};base64,{base64_image}"},
+                },
+            ],
+            }
         ],
-        }
-    ],
-)
-answer = response.choices[0]
-content = answer.message.content
-print(content)
+    )
+    answer = response.choices[0]
+    content = answer.message.content
+    return content
+
+
+def ocr_with_retries(client, data, mime, retries=5):
+    """ocr image, retry with exponential backoff on connection, server and rate limit errors"""
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    for attempt in range(retries+1):
+        try:
+            return ocr_image(client, data, mime)
+        except (APIConnectionError, InternalServerError, RateLimitError):
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt + random.random())
+
+
+def read_done(output):
+    """content hashes of images already processed, from jsonl output"""
+    done = set()
+    if not output.exists():
+        return done
+    with open(output, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # last line may be broken by interrupted run
+                continue
+            if 'text' in record:
+                done.add(record['sha256'])
+    return done
+
+
+def ocr_piece(client, data, retries, options):
+    """prepare and ocr page or tile, return text, bytes sent and mime type"""
+    prepared, mime = prepare_image(data, **options)
+    return ocr_with_retries(client, prepared, mime, retries), len(prepared), mime
+
+
+class RequestPool:
+    """Thread pool of ocr requests, which holds at most workers + queued pieces (pages, tiles).
+    submit blocks when it's full, so pdfs are rendered only as fast as their pages are sent,
+    instead of keeping all of them in memory.
+    """
+    def __init__(self, workers, queued=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + (workers if queued is None else queued))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def submit(self, func, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        # also called for cancelled futures
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+def process_image(client, path, digest, retries, options, pool=None):
+    """ocr single image or pdf, return jsonl record
+
+    Pages and tiles are sent to pool (RequestPool), as soon as they are ready and there is
+    space for them, and their text is merged in reading order. Without pool they are sent
+    one by one.
+    """
+    record = {'path': str(path), 'sha256': digest}
+    options = dict(options)
+    split = {key: options.pop(key) for key in ('tile_height', 'overlap', 'dpi') if key in options}
+    start = time.perf_counter()
+    try:
+        pieces = []  # (page, future or result)
+        for page, data in document_pieces(path, options.get('max_size', 2048), **split):
+            if pool is None:
+                pieces.append((page, ocr_piece(client, data, retries, options)))
+            else:
+                pieces.append((page, pool.submit(ocr_piece, client, data, retries, options)))
+        pages = {}
+        sent = 0
+        mime = None
+        for page, piece in pieces:
+            text, size, mime = piece if pool is None else piece.result()
+            pages.setdefault(page, []).append(text)
+            sent += size
+        record.update(bytes_original=Path(path).stat().st_size, bytes_sent=sent, mime=mime, pages=len(pages), pieces=len(pieces))
+        record['text'] = '\n\n'.join(merge_texts(texts) for texts in pages.values())
+    except Exception as err:
+        record['error'] = f'{type(err).__name__}: {err}'
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def describe(record):
+    """size reduction and latency of processed image"""
+    if 'bytes_sent' not in record:
+        return f'{record["seconds"]}s'
+    original, sent = record['bytes_original'], record['bytes_sent']
+    saved = 100 * (original - sent) / original if original else 0
+    pieces = f', {record["pages"]} pages, {record["pieces"]} pieces' if record.get('pieces', 1) > 1 else ''
+    return f'{original / 1024:.0f}KB -> {sent / 1024:.0f}KB (saved {saved:.1f}%){pieces}, {record["seconds"]}s'
+
+
+def run_batch(client, paths, output, workers=4, retries=5, options=None):
+    """ocr images using pool of workers, append results to jsonl output, skip those already done
+
+    Files are prepared by one pool and their pieces (pages, tiles) are sent by another one,
+    so there are at most workers requests in flight, whatever number of pieces files have.
+    """
+    done = read_done(output)
+    hashes = {path: file_hash(path) for path in paths}
+    todo = [path for path in paths if hashes[path] not in done]
+    print(f'[*] images: {len(paths)}, already done: {len(paths) - len(todo)}, to process: {len(todo)}')
+    if not todo:
+        return
+    failed = 0
+    start = time.perf_counter()
+    if output.exists() and output.stat().st_size:
+        # make sure broken record from interrupted run doesn't swallow the next one
+        with open(output, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+    requests = RequestPool(workers)
+    with open(output, 'a', encoding='utf-8') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_image, client, path, hashes[path], retries, options or {}, requests) for path in todo]
+        try:
+            for index, future in enumerate(as_completed(futures), start=1):
+                record = future.result()
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.flush()
+                rate = index / (time.perf_counter() - start)
+                status = 'failed' if 'error' in record else 'done'
+                failed += 'error' in record
+                print(f'[*] {index}/{len(todo)}) {status}: {record["path"]}, {describe(record)} ({rate:.2f} img/s)')
+        except KeyboardInterrupt:
+            print('\n[*] broken by user, run again to resume')
+            executor.shutdown(wait=False, cancel_futures=True)
+            requests.shutdown(wait=False, cancel_futures=True)
+            return
+    requests.shutdown()
+    elapsed = time.perf_counter() - start
+    print(f'[*] processed {len(todo)} images in {elapsed:.1f}s ({len(todo) / elapsed:.2f} img/s), failed: {failed}')
+    print(f'[*] results saved to: {output}')
+
+
+if __name__ == "__main__":
+    # **** args ****
+    parser = argparse.ArgumentParser(usage="python ocr.py image.png|document.pdf\n       python ocr.py DIR/GLOB [-o ocr.jsonl]")
+    parser.add_argument("source", help="Image or pdf file, directory or glob pattern")
+    parser.add_argument("-o", "--output", default="ocr.jsonl", help="JSONL file for batch results (appended, resumable)")
+    parser.add_argument("-w", "--workers", default=4, type=int, help="Number of parallel requests")
+    parser.add_argument("--retries", default=5, type=int, help="Number of retries per image")
+    parser.add_argument("--max-size", default=2048, type=int, help="Downsize images to this longer side in px (0 to keep size)")
+    parser.add_argument("--quality", default=85, type=int, help="JPEG quality of recompressed images")
+    parser.add_argument("--grayscale", action='store_true', help="Convert images to grayscale before upload")
+    parser.add_argument("--tile-height", default=1536, type=int, help="Split taller images into overlapping bands of this height in px (0 to send whole)")
+    parser.add_argument("--overlap", default=192, type=int, help="Overlap of bands in px, should fit a few lines of text")
+    parser.add_argument("--dpi", default=200, type=int, help="Resolution of rendered pdf pages")
+    args = parser.parse_args()
+    options = {'max_size': args.max_size, 'grayscale': args.grayscale, 'quality': args.quality, 'tile_height': args.tile_height, 'overlap': args.overlap, 'dpi': args.dpi}
+
+    # **** config ****
+    from dotenv import dotenv_values
+    from openai import OpenAI
+    config = dotenv_values()
+    OPENAI_API_KEY = config.get("OPENAI-API-KEY")  # OPENAI_API_KEY and OPENAI_BASE_URL env variables work too
+    client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+    # **** single image ****
+    image_path = Path(args.source)
+    if image_path.is_file():
+        # pages and tiles of single file are sent at once
+        with RequestPool(args.workers) as pool:
+            record = process_image(client, image_path, None, args.retries, options, pool)
+        if 'error' in record:
+            raise Exception(record['error'])
+        print(record['text'])
+        print(f'[*] {describe(record)}', file=sys.stderr)
+    else:
+        # **** batch ****
+        paths = find_images(args.source)
+        if not paths:
+            raise Exception(f'no images found: {args.source}')
+        run_batch(client, paths, Path(args.output), args.workers, args.retries, options)
@@ -0,0 +1,256 @@
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from rich import print
+
+# numpy and ollama are imported on first use, retrieval is optional and numpy is not required otherwise
+EMBEDDING_MODEL = 'nomic-embed-text'
+CONTEXT_PROMPT = 'Relevant parts of earlier conversations, use them if they help:'
+
+
+class VectorIndex:
+    """Normalized float32 vectors kept in memory and appended to raw file on disk, with items
+    (dicts) appended to jsonl file in the same order. Search is single matrix-vector product.
+
+    Vectors dimension is kept in small json file, written before the first vectors, so rows
+    of raw file are known even when its end is torn.
+    """
+    def __init__(self, path):
+        import numpy as np
+        self.np = np
+        self.vectors_path = Path(path).with_suffix('.f32')
+        self.items_path = Path(path).with_suffix('.jsonl')
+        self.meta_path = Path(path).with_suffix('.json')
+        self.lock = threading.Lock()
+        self.items = []
+        self.vectors = None  # preallocated matrix, first len(self.items) rows are used
+        self.dim = None
+        if self.meta_path.exists():
+            self._load()
+        else:
+            # without dimension rows can't be told apart, index is rebuilt from conversations
+            self.vectors_path.unlink(missing_ok=True)
+            self.items_path.unlink(missing_ok=True)
+        self.keys = set()
+        self.done = {}  # conversation name -> number of turns in index
+        self._remember(self.items)
+
+    def _load(self):
+        """read index, dropping what interrupted add() left: vectors without items or partial lines"""
+        np = self.np
+        self.dim = json.loads(self.meta_path.read_text(encoding='utf-8'))['dim']
+        lines = []
+        if self.items_path.exists():
+            with open(self.items_path, encoding='utf-8') as f:
+                lines = f.readlines()
+        items = [json.loads(line) for line in lines if line.endswith('\n')]
+        if self.vectors_path.exists():
+            data = np.fromfile(self.vectors_path, dtype=np.float32)
+        else:
+            data = np.empty(0, dtype=np.float32)
+        count = min(len(items), data.size // self.dim)
+        # cut files back to complete rows, so next add() appends right after them
+        if data.size != count * self.dim:
+            os.truncate(self.vectors_path, count * self.dim * data.itemsize)
+        if len(lines) != count:
+            self.items_path.write_text(''.join(lines[:count]), encoding='utf-8')
+        self.items = items[:count]
+        if count:
+            self.vectors = data[:count * self.dim].reshape(count, self.dim)
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, vectors, items):
+        """add vectors (list of lists) with their items, both in memory and on disk"""
+        np = self.np
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) != len(items):
+            raise ValueError(f'{len(vectors)} vectors for {len(items)} items')
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self.lock:
+            if self.dim is None:
+                self.meta_path.parent.mkdir(exist_ok=True)
+                self.meta_path.write_text(json.dumps({'dim': vectors.shape[1]}), encoding='utf-8')
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f'vectors of dimension {vectors.shape[1]} added to index of dimension {self.dim}')
+            count = len(self.items)
+            if self.vectors is None:
+                self.vectors = np.empty((max(1024, len(vectors)), vectors.shape[1]), dtype=np.float32)
+            elif count + len(vectors) > len(self.vectors):
+                # grow by doubling, so adding one by one costs amortized O(1)
+                grown = np.empty((max(2 * len(self.vectors), count + len(vectors)), self.vectors.shape[1]), dtype=np.float32)
+                grown[:count] = self.vectors[:count]
+                self.vectors = grown
+            self.vectors[count:count + len(vectors)] = vectors
+            # vectors first, so torn add leaves rows without items, which are cut on load
+            with open(self.vectors_path, 'ab') as f:
+                vectors.tofile(f)
+            with open(self.items_path, 'a', encoding='utf-8') as f:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False) + '\n')
+            self.items.extend(items)
+            self._remember(items)
+
+    def _remember(self, items):
+        for item in items:
+            self.keys.add((item['name'], item['turn']))
+            self.done[item['name']] = max(self.done.get(item['name'], 0), item['turn'])
+
+    def search(self, vector, k=4, exclude=None):
+        """k items most similar to vector, skipping those for which exclude(item) is true"""
+        np = self.np
+        with self.lock:
+            count = len(self.items)
+            if not count:
+                return []
+            vectors = self.vectors[:count]
+        vector = np.asarray(vector, dtype=np.float32)
+        scores = vectors @ (vector / max(np.linalg.norm(vector), 1e-12))
+        # best candidates are enough unless many of them are excluded
+        candidates = min(count, 4 * k + 16)
+        order = np.argpartition(-scores, candidates - 1)[:candidates]
+        order = order[np.argsort(-scores[order])]
+        hits = self._pick(order, scores, k, exclude)
+        if len(hits) < k and candidates < count:
+            hits = self._pick(np.argsort(-scores), scores, k, exclude)
+        return hits
+
+    def _pick(self, order, scores, k, exclude):
+        hits = []
+        for index in order:
+            item = self.items[index]
+            if exclude is None or not exclude(item):
+                hits.append((float(scores[index]), item))
+                if len(hits) == k:
+                    break
+        return hits
+
+    def turns(self, name):
+        """number of turns of conversation already in index"""
+        return self.done.get(name, 0)
+
+
+def conversation_turns(messages):
+    """(turn number, question, answer) of conversation, turns are numbered from 1 like in index"""
+    turn = 0
+    question = None
+    for message in messages:
+        if not message:
+            continue
+        if message.get('role') == 'user':
+            turn += 1
+            question = message.get('content')
+        elif message.get('role') == 'assistant' and question is not None:
+            yield turn, question, message.get('content') or ''
+            question = None
+
+
+class Retriever:
+    """Sends top-k relevant earlier turns (of current and saved conversations) plus last few
+    messages, instead of whole conversation.
+
+    Turns are embedded with Ollama embeddings endpoint, in background thread, so answers
+    don't wait for it. Only question has to be embedded before request.
+    """
+    def __init__(self, store, model=EMBEDDING_MODEL, top_k=4, recent=6):
+        self.store = store
+        self.model = model
+        self.top_k = top_k
+        self.recent = recent
+        name = re.sub(r'[^0-9A-Za-z_.]', '_', model)
+        self.index = VectorIndex(store.directory / 'vectors' / name)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.last = []  # turns retrieved for last request
+
+    def embed(self, texts):
+        import ollama
+        return ollama.embed(model=self.model, input=texts)['embeddings']
+
+    def check(self):
+        """raise if embedding model can't be used, e.g. Ollama is not running or model is not pulled"""
+        self.embed(['check'])
+
+    def add_turn(self, name, turn, question, answer):
+        """embed turn in background"""
+        self.executor.submit(self._add, [{'name': name, 'turn': turn, 'question': question, 'answer': answer}])
+
+    def index_conversations(self, batch_size=64):
+        """embed turns of saved conversations, which are not in index yet, in background"""
+        self.executor.submit(self._index_conversations, batch_size)
+
+    def _index_conversations(self, batch_size):
+        index = self.store.index
+        index.refresh()
+        todo = [
+            row['name'] for row in index.query(limit=-1)
+            if row['turns'] > self.index.turns(row['name'])
+        ]
+        items = []
+        for name in todo:
+            messages, _ = self.store.read(self.store.directory / name)
+            done = self.index.turns(name)
+            for turn, question, answer in conversation_turns(messages):
+                if turn > done:
+                    items.append({'name': name, 'turn': turn, 'question': question, 'answer': answer})
+            while len(items) >= batch_size:
+                if not self._add(items[:batch_size]):
+                    return
+                items = items[batch_size:]
+        if items:
+            self._add(items)
+
+    def _add(self, items):
+        """embed and add turns to index, return False if embedding failed"""
+        items = [item for item in items if (item['name'], item['turn']) not in self.index.keys]
+        if not items:
+            return True
+        try:
+            vectors = self.embed([f"user: {item['question']}\nassistant: {item['answer']}" for item in items])
+        except Exception as err:
+            print(f'[red]\\[x] failed to embed turns: {type(err).__name__}: {err}[/red]')
+            return False
+        self.index.add(vectors, items)
+        return True
+
+    def select(self, messages, name=None):
+        """system message, relevant earlier turns and recent messages, None if question can't be embedded"""
+        system, history = messages[:1], messages[1:]
+        if len(history) <= self.recent:
+            self.last = []
+            return messages
+        recent = history[-self.recent:]
+        while len(recent) > 1 and recent[0].get('role') == 'assistant':
+            recent = recent[1:]
+        # turns of current conversation still in recent messages are sent anyway
+        first_recent = sum(1 for message in history[:len(history) - len(recent)] if message and message.get('role') == 'user') + 1
+
+        def exclude(item):
+            return item['name'] == name and item['turn'] >= first_recent
+
+        try:
+            vector = self.embed([str(messages[-1].get('content') or '')])[0]
+        except Exception as err:
+            print(f'[red]\\[x] failed to embed question, recent history is sent instead: {type(err).__name__}: {err}[/red]')
+            self.last = []
+            return None
+        try:
+            hits = self.index.search(vector, self.top_k, exclude)
+        except Exception as err:
+            print(f'[red]\\[x] failed to search earlier turns, recent history is sent instead: {type(err).__name__}: {err}[/red]')
+            self.last = []
+            return None
+        self.last = [item for _, item in hits]
+        if not hits:
+            return system + recent
+        turns = '\n\n'.join(f"user: {item['question']}\nassistant: {item['answer']}" for item in self.last)
+        context = {"role": "system", "content": f'{CONTEXT_PROMPT}\n\n{turns}'}
+        return system + [context] + recent
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,131 @@
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from rich import print
+
+try:
+    # to support linux terminal
+    import readline
+except ImportError:
+    readline = None
+
+
+class Session:
+    """Named conversation with its own client, asked in foreground or in background"""
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.future = None  # request running in background
+        self.ready = []  # (question, answer, error) answered in background, not viewed yet
+
+    @property
+    def busy(self):
+        return self.future is not None and not self.future.done()
+
+    def status(self):
+        if self.busy:
+            return '[yellow]waiting[/yellow]'
+        if self.ready:
+            return f'[green]{len(self.ready)} ready[/green]'
+        return 'idle'
+
+
+class Sessions:
+    """Sessions of single REPL, questions asked in background overlap with each other
+    and with whatever is done in current session. Every session has at most one request
+    in flight, as its answer is a part of the next request.
+
+    Notification of ready answer is printed above the prompt when terminal waits for input,
+    otherwise it waits for the next prompt, so it never mixes with answer being printed.
+    """
+    def __init__(self, client, name='main', workers=8):
+        self.sessions = {name: Session(name, client)}
+        self.current = self.sessions[name]
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.prompt = None  # prompt shown by input() right now
+        self.notices = []  # notifications to print before next prompt
+
+    def __contains__(self, name):
+        return name in self.sessions
+
+    def __iter__(self):
+        return iter(self.sessions.values())
+
+    def add(self, name, client):
+        self.sessions[name] = Session(name, client)
+        return self.sessions[name]
+
+    def switch(self, name):
+        self.current = self.sessions[name]
+        return self.current
+
+    def input(self, prompt):
+        """input() which lets background threads print notifications while it waits"""
+        with self.lock:
+            notices, self.notices = self.notices, []
+        for notice in notices:
+            print(notice)
+        with self.lock:
+            self.prompt = prompt
+        try:
+            return input(prompt)
+        finally:
+            with self.lock:
+                self.prompt = None
+
+    def ask(self, question, use_cache=True):
+        """ask current session in background, False if it's still waiting for previous answer"""
+        session = self.current
+        if session.busy:
+            return False
+        session.future = self.executor.submit(session.client.ask, question, use_cache)
+        session.future.add_done_callback(lambda future: self._done(session, question, future))
+        return True
+
+    def _done(self, session, question, future):
+        error = future.exception()
+        answer = None if error else future.result()
+        with self.lock:
+            session.ready.append((question, answer, f'{type(error).__name__}: {error}' if error else None))
+        if session is self.current:
+            hint = 'type "show" to view it'
+        else:
+            hint = f'type "session {session.name}" to view it'
+        self._notify(f'[green][*] answer ready in session [cyan]{session.name}[/cyan], {hint}[/green]')
+
+    def _notify(self, text):
+        with self.lock:
+            if self.prompt is None:
+                self.notices.append(text)
+                return
+            # print above prompt line, then restore prompt with what was typed so far
+            typed = readline.get_line_buffer() if readline else ''
+            sys.stdout.write('\r\x1b[K')
+            print(text)
+            sys.stdout.write(self.prompt + typed)
+            sys.stdout.flush()
+
+    def take_ready(self):
+        """answers of current session ready to view, they are shown once"""
+        with self.lock:
+            ready, self.current.ready = self.current.ready, []
+        return ready
+
+    def show(self):
+        from rich.table import Table
+        table = Table(title='sessions')
+        for header in ('', 'name', 'model', 'messages', 'status'):
+            table.add_column(header)
+        for session in self:
+            marker = '*' if session is self.current else ''
+            table.add_row(marker, session.name, session.client.model, str(len(session.client.messages) - 1), session.status())
+        print(table)
+
+    def close(self):
+        """wait for answers still in flight, they are saved with their conversations"""
+        waiting = [session.name for session in self if session.busy]
+        if waiting:
+            print(f"[*] waiting for answers in sessions: {', '.join(waiting)}")
+        self.executor.shutdown(wait=True)
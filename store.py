@@ -0,0 +1,310 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from rich import print
+
+
+class ConversationStore:
+    """Append-only conversations storage, one json record per line.
+
+    Records are messages (dicts with "role" key) or metadata ({"meta": {...}}), where
+    later metadata updates earlier one. Every record is flushed to disk as it is appended,
+    so crash loses nothing, and each turn costs the same no matter how long conversation is.
+    """
+    def __init__(self, directory='conversations'):
+        self.directory = Path(directory)
+        self.files = {}  # path -> opened file
+        self.lock = threading.Lock()
+        self._index = None
+
+    @property
+    def index(self):
+        """metadata index, opened on first use"""
+        if self._index is None:
+            self.directory.mkdir(exist_ok=True)
+            self._index = ConversationIndex(self.directory)
+        return self._index
+
+    def path(self, conversation_id, model):
+        return self.directory / f'{conversation_id}-{model}.jsonl'
+
+    def create(self, conversation_id, model, system_message=None):
+        """start new conversation log, id gets suffix if it is already taken"""
+        with self.lock:
+            # many clients may share the store (e.g. daemon sessions) and start conversations in the same second
+            path = self.path(conversation_id, model)
+            base, number = conversation_id, 1
+            while path in self.files or path.exists():
+                conversation_id = f'{base}_{number}'
+                path = self.path(conversation_id, model)
+                number += 1
+            self.directory.mkdir(exist_ok=True)
+            self.files[path] = open(path, 'a', encoding='utf-8')
+        meta = {'id': conversation_id, 'model': model, 'created': time.time()}
+        self.append(path, {'meta': meta})
+        if system_message is not None:
+            self.append(path, system_message)
+        return path
+
+    def append(self, path, record):
+        """durably append single record"""
+        fp = self.files.get(path)
+        if fp is None:
+            self.directory.mkdir(exist_ok=True)
+            fp = open(path, 'a', encoding='utf-8')
+            self.files[path] = fp
+        fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    def update_meta(self, path, **meta):
+        self.append(path, {'meta': meta})
+
+    def close(self, path=None):
+        """close log file(s), they are reopened on next append"""
+        paths = [path] if path is not None else list(self.files)
+        for item in paths:
+            fp = self.files.pop(item, None)
+            if fp is not None:
+                fp.close()
+                self.index.update(item)
+
+    def read(self, path):
+        """read messages and metadata, broken records (e.g. interrupted write) are skipped"""
+        path = Path(path)
+        if path.suffix == '.json':
+            return read_json_conversation(path), {}
+        messages = []
+        meta = {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'meta' in record:
+                    meta.update(record['meta'])
+                else:
+                    messages.append(record)
+        return messages, meta
+
+    def compact(self, path):
+        """rewrite log with single metadata record and without broken lines"""
+        self.close(path)
+        messages, meta = self.read(path)
+        write_records(path, [{'meta': meta}] + messages)
+        self.index.update(path, full=True)
+
+    def migrate(self):
+        """import conversations saved as single .json files, return list of created logs"""
+        created = []
+        for json_path in sorted(self.directory.glob('*.json')):
+            path = json_path.with_suffix('.jsonl')
+            if path.exists():
+                continue
+            messages = read_json_conversation(json_path)
+            if not messages:
+                continue
+            conversation_id, _, model = json_path.stem.partition('-')
+            meta = {'id': conversation_id, 'model': model, 'created': json_path.stat().st_mtime, 'migrated_from': json_path.name}
+            write_records(path, [{'meta': meta}] + messages)
+            created.append(path)
+        return created
+
+    def conversations(self):
+        """all conversation logs"""
+        return sorted(self.directory.glob('*.jsonl'))
+
+
+class ConversationIndex:
+    """SQLite index of conversations metadata and full text of messages, so they can be listed
+    and searched without opening them.
+
+    Updated when conversation log is closed, refresh() picks up files added or changed
+    outside of chat, comparing size and modification time of files with indexed ones.
+    Logs are only appended to, so update reads just the part added since last one.
+    Message rowid in full text index is conversation rowid << 32 | message number,
+    so messages of conversation are removed by rowid range.
+    """
+    VERSION = 2
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.directory / 'index.sqlite', check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+            # index is rebuilt from logs, so older one is just dropped
+            self.db.execute('DROP TABLE IF EXISTS conversations')
+            self.db.execute('DROP TABLE IF EXISTS messages')
+            self.db.execute(f'PRAGMA user_version = {self.VERSION}')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS conversations ('
+            'name TEXT PRIMARY KEY, id TEXT, model TEXT, created REAL, updated REAL, '
+            'turns INTEGER, first_line TEXT, bytes INTEGER, indexed INTEGER, messages INTEGER)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated)')
+        self.db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(content, turn UNINDEXED, role UNINDEXED)')
+        self.db.commit()
+
+    def update(self, path, commit=True, full=False):
+        """(re)index single conversation log, from where previous update stopped unless full=True"""
+        path = Path(path)
+        stat = path.stat()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT rowid, id, model, created, turns, first_line, indexed, messages FROM conversations WHERE name = ?',
+                (path.name,)
+            ).fetchone()
+            if row is None or full or stat.st_size < row[6]:
+                # new or rewritten log
+                conversation_id, _, model = path.stem.partition('-')
+                meta = {'id': conversation_id, 'model': model, 'created': stat.st_mtime}
+                turns, first_line, offset, count = 0, '', 0, 0
+                if row is not None:
+                    self.db.execute('DELETE FROM messages WHERE rowid BETWEEN ? AND ?', (row[0] << 32, (row[0] << 32) | 0xffffffff))
+            else:
+                _, conversation_id, model, created, turns, first_line, offset, count = row
+                meta = {'id': conversation_id, 'model': model, 'created': created}
+            self.db.execute(
+                'INSERT INTO conversations (name, id, model, created, updated, turns, first_line, bytes, indexed, messages) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (name) DO NOTHING',
+                (path.name, meta['id'], meta['model'], meta['created'], stat.st_mtime, 0, '', 0, 0, 0)
+            )
+            rowid = self.db.execute('SELECT rowid FROM conversations WHERE name = ?', (path.name,)).fetchone()[0]
+            rows = []
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # being written right now, will be indexed next time
+                        break
+                    offset += len(line)
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if 'meta' in record:
+                        meta.update(record['meta'])
+                        continue
+                    if record.get('role') == 'user':
+                        turns += 1
+                        if not first_line:
+                            first_line = str(record.get('content', '')).strip().split('\n', maxsplit=1)[0][:120]
+                    count += 1
+                    rows.append(((rowid << 32) | count, str(record.get('content') or ''), turns, record.get('role')))
+            self.db.executemany('INSERT INTO messages (rowid, content, turn, role) VALUES (?, ?, ?, ?)', rows)
+            self.db.execute(
+                'UPDATE conversations SET id = ?, model = ?, created = ?, updated = ?, turns = ?, first_line = ?, '
+                'bytes = ?, indexed = ?, messages = ? WHERE rowid = ?',
+                (meta.get('id'), meta.get('model'), meta.get('created'), stat.st_mtime, turns, first_line,
+                 stat.st_size, offset, count, rowid)
+            )
+            if commit:
+                self.db.commit()
+
+    def refresh(self):
+        """index new and changed logs, drop removed ones, return number of changes"""
+        files = {entry.name: entry.stat() for entry in os.scandir(self.directory) if entry.name.endswith('.jsonl')}
+        with self.lock:
+            known = {name: (size, updated) for name, size, updated in self.db.execute('SELECT name, bytes, updated FROM conversations')}
+        changes = 0
+        for name, stat in files.items():
+            if known.get(name) != (stat.st_size, stat.st_mtime):
+                self.update(self.directory / name, commit=False)
+                changes += 1
+        removed = known.keys() - files.keys()
+        with self.lock:
+            for name in removed:
+                self.remove(name)
+            self.db.commit()
+        return changes + len(removed)
+
+    def remove(self, name):
+        row = self.db.execute('SELECT rowid FROM conversations WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            self.db.execute('DELETE FROM messages WHERE rowid BETWEEN ? AND ?', (row[0] << 32, (row[0] << 32) | 0xffffffff))
+            self.db.execute('DELETE FROM conversations WHERE rowid = ?', row)
+
+    def query(self, pattern='', limit=20, offset=0):
+        """most recent conversations, fuzzy matching pattern (chars in order) against id, model and first line"""
+        like = '%' + '%'.join(char.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') for char in pattern) + '%'
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, id, model, updated, turns, first_line, bytes FROM conversations "
+                "WHERE (id || ' ' || model || ' ' || first_line) LIKE ? ESCAPE '\\' "
+                "ORDER BY updated DESC LIMIT ? OFFSET ?",
+                (like, limit, offset)
+            ).fetchall()
+        keys = ('name', 'id', 'model', 'updated', 'turns', 'first_line', 'bytes')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def search(self, terms, limit=20, mark=('\x01', '\x02')):
+        """messages matching all terms, best first, with snippet where matches are surrounded by mark"""
+        # every term quoted, so user input is never taken for fts query syntax
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in terms.split())
+        if not match:
+            return []
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT c.name, c.id, c.model, hits.turn, hits.role, hits.snippet FROM ("
+                "SELECT rowid, turn, role, snippet(messages, 0, ?, ?, '...', 16) AS snippet, rank "
+                "FROM messages WHERE messages MATCH ? ORDER BY rank LIMIT ?"
+                ") AS hits JOIN conversations AS c ON c.rowid = hits.rowid >> 32 ORDER BY hits.rank",
+                (*mark, match, limit)
+            ).fetchall()
+        keys = ('name', 'id', 'model', 'turn', 'role', 'snippet')
+        return [dict(zip(keys, row)) for row in rows]
+
+
+def read_json_conversation(path):
+    """read conversation saved as single json list"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError) as err:
+        print(f'[red]\\[x] {type(err).__name__}: {path}[/red]')
+        return []
+
+
+def write_records(path, records):
+    """write records to temporary file and move it to path, so log is never left half written"""
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+if __name__ == "__main__":
+    os.chdir(str(Path(__file__).parent))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=["migrate", "compact", "index"], help="Import .json conversations / compact .jsonl logs / update index")
+    args = parser.parse_args()
+    store = ConversationStore()
+    if args.action == 'migrate':
+        created = store.migrate()
+        print(f'[*] migrated conversations: {len(created)}')
+    elif args.action == 'index':
+        changes = store.index.refresh()
+        print(f'[*] conversations index updated: {changes} changes')
+    else:
+        paths = store.conversations()
+        before = sum(path.stat().st_size for path in paths)
+        for path in paths:
+            store.compact(path)
+        after = sum(path.stat().st_size for path in paths)
+        print(f'[*] compacted conversations: {len(paths)}, {before / 1024:.0f}KB -> {after / 1024:.0f}KB')
@@ -1,46 +1,176 @@
+import argparse
+import hashlib
 import os
-import json
+import re
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from rich import print
 
-def now():
-    """datetime now"""
-    return time.strftime("%Y%m%d%H%M%S")
+from rich import print
 
-def write_json(filename, data):
-    """write to json file"""
-    with open(filename, 'w', encoding='utf-8') as fp:
-        json.dump(data, fp, sort_keys=True, indent=4, ensure_ascii=False)
-    return True
+from chat import SYSTEM_MESSAGE
+from store import ConversationStore, write_records
 
-def save_conversation(messages):
-    if len(messages) < 2:
-        # we skip system message
-        return
-    directory = Path('conversations')
-    directory.mkdir(exist_ok=True)
-    filename = f"{now()}.json"
-    path = directory / filename
-    write_json(path, messages)
-    print(f"[*] conversation saved to: [cyan]{path}[/cyan]")
-
-# load conversation from .txt
-filename = 'conversations/20231201-talk.txt'
-system_message = {"role": "system", "content": "rule: reply directly without long summaries and comments, in few words"}
-messages = [system_message]
-matching = {
+# transcript line starting a message, e.g. "[*] me: question" or "12:01 gpt: answer"
+# other lines continue previous message, so messages may span many lines
+HEADER = re.compile(r'^\S+\s+(?P<speaker>\w+):(?: (?P<content>.*))?$')
+# header of unknown speaker has to start with transcript marker, e.g. "[*] bot: ...", as answers
+# often have lines like "for example: ..."
+HEADER_PREFIX = re.compile(r'^(\[.\]|\d{1,2}:\d{2}(:\d{2})?)\s')
+ROLES = {
     'me': 'user',
     'gpt': 'assistant',
 }
-path = Path(filename)
-lines = [line.strip() for line in path.read_text().splitlines() if line.strip()]
-for line in lines:
-    _, role, content = line.split(None, maxsplit=2)
-    role = role.rstrip(':')
-    role = matching[role]
-    submessage = {'role': role, 'content': content}
-    messages.append(submessage)
-
-# save conversation as .json
-save_conversation(messages)
+MAX_REPORTED = 20  # malformed lines reported per file, all are counted
+
+
+class Malformed:
+    """Lines that can't be a part of any message, all are counted, only first few kept"""
+    def __init__(self, limit=MAX_REPORTED):
+        self.limit = limit
+        self.count = 0
+        self.lines = []  # (line number, line)
+
+    def add(self, number, line):
+        self.count += 1
+        if len(self.lines) < self.limit:
+            self.lines.append((number, line))
+
+
+def parse_transcript(lines, malformed):
+    """yield messages from transcript lines, one by one, so file of any size takes constant memory"""
+    role = None
+    rows = []
+    for number, line in enumerate(lines, start=1):
+        line = line.rstrip('\r\n')
+        match = HEADER.match(line)
+        if match and match['speaker'] in ROLES:
+            if role is not None:
+                yield {'role': role, 'content': '\n'.join(rows).strip()}
+            role = ROLES[match['speaker']]
+            rows = [match['content'] or '']
+        elif match and HEADER_PREFIX.match(line):
+            # message of unknown speaker ends previous one, its lines are malformed
+            if role is not None:
+                yield {'role': role, 'content': '\n'.join(rows).strip()}
+            role = None
+            malformed.add(number, line)
+        elif role is not None:
+            rows.append(line)
+        elif line.strip():
+            # text before first message, or message of unknown speaker
+            malformed.add(number, line)
+    if role is not None:
+        yield {'role': role, 'content': '\n'.join(rows).strip()}
+
+
+def transcript_id(path, root=None):
+    """conversation id from transcript path relative to root (imported directory), or from its name,
+    without dashes as they separate id from model in log names
+    """
+    path = Path(path)
+    name = path.relative_to(root).with_suffix('') if root else Path(path.stem)
+    return re.sub(r'[^0-9A-Za-z_]', '_', name.as_posix())
+
+
+def transcript_ids(paths, root=None):
+    """ids of transcripts, those which would be the same (e.g. a/b.txt and a_b.txt) get path hash"""
+    ids = {path: transcript_id(path, root) for path in paths}
+    counts = {}
+    for conversation_id in ids.values():
+        counts[conversation_id] = counts.get(conversation_id, 0) + 1
+    for path, conversation_id in ids.items():
+        if counts[conversation_id] > 1:
+            relative = Path(path).relative_to(root) if root else Path(path)
+            digest = hashlib.sha1(relative.as_posix().encode('utf-8')).hexdigest()[:8]
+            ids[path] = f'{conversation_id}_{digest}'
+    return ids
+
+
+def conversation_records(path, conversation_id, model, malformed):
+    """records of conversation log: metadata, system message and messages"""
+    meta = {'id': conversation_id, 'model': model, 'created': path.stat().st_mtime, 'imported_from': str(path)}
+    yield {'meta': meta}
+    yield SYSTEM_MESSAGE
+    with open(path, encoding='utf-8', errors='replace') as f:
+        yield from parse_transcript(f, malformed)
+    if malformed.count:
+        yield {'meta': {'malformed_lines': malformed.count}}
+
+
+def import_transcript(path, directory, model='imported', force=False, conversation_id=None):
+    """convert single transcript to conversation log, return summary of import"""
+    path = Path(path)
+    conversation_id = conversation_id or transcript_id(path)
+    output = ConversationStore(directory).path(conversation_id, model)
+    summary = {'path': str(path), 'output': str(output), 'messages': 0, 'malformed': 0, 'reported': [], 'skipped': False}
+    if output.exists() and not force:
+        summary['skipped'] = True
+        return summary
+    malformed = Malformed()
+
+    def counted(records):
+        for record in records:
+            summary['messages'] += 'role' in record
+            yield record
+
+    write_records(output, counted(conversation_records(path, conversation_id, model, malformed)))
+    summary['malformed'] = malformed.count
+    summary['reported'] = malformed.lines
+    if summary['messages'] < 2:
+        # only system message
+        output.unlink()
+        summary['output'] = None
+    return summary
+
+
+def find_transcripts(source, pattern='*.txt'):
+    source = Path(source)
+    if source.is_dir():
+        return sorted(path for path in source.rglob(pattern) if path.is_file())
+    return [source]
+
+
+def report(summary):
+    if summary['skipped']:
+        print(f"[*] skipped, already imported: {summary['path']}")
+        return
+    status = f"[cyan]{summary['output']}[/cyan]" if summary['output'] else '[yellow]no messages[/yellow]'
+    print(f"[*] {summary['path']} -> {status}, messages: {summary['messages'] - 1}, malformed lines: {summary['malformed']}")
+    for number, line in summary['reported']:
+        print(f"    line {number}: {line[:120]!r}")
+    if summary['malformed'] > len(summary['reported']):
+        print(f"    ... and {summary['malformed'] - len(summary['reported'])} more")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import chat transcripts (.txt) as conversations, which can be loaded in chat.py")
+    parser.add_argument("source", help="Transcript file or directory with transcripts")
+    parser.add_argument("-o", "--output", default=str(Path(__file__).parent / 'conversations'), help="Conversations directory")
+    parser.add_argument("-w", "--workers", default=os.cpu_count(), type=int, help="Number of files imported in parallel")
+    parser.add_argument("--pattern", default="*.txt", help="Transcripts file pattern, when importing directory")
+    parser.add_argument("--model", default="imported", help="Model name saved with conversations")
+    parser.add_argument("--force", action='store_true', help="Import again transcripts imported before")
+    args = parser.parse_args()
+
+    paths = find_transcripts(args.source, args.pattern)
+    # transcripts with the same name in different directories are separate conversations
+    ids = transcript_ids(paths, args.source if Path(args.source).is_dir() else None)
+    directory = Path(args.output)
+    directory.mkdir(exist_ok=True)
+    start = time.perf_counter()
+    summaries = []
+    if len(paths) == 1:
+        summaries.append(import_transcript(paths[0], directory, args.model, args.force, ids[paths[0]]))
+        report(summaries[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(import_transcript, path, directory, args.model, args.force, ids[path]) for path in paths]
+            for future in as_completed(futures):
+                summaries.append(future.result())
+                report(summaries[-1])
+    changes = ConversationStore(directory).index.refresh()
+    elapsed = time.perf_counter() - start
+    imported = sum(1 for summary in summaries if summary['output'] and not summary['skipped'])
+    malformed = sum(summary['malformed'] for summary in summaries)
+    print(f'[*] imported {imported}/{len(paths)} transcripts in {elapsed:.1f}s, malformed lines: {malformed}, index changes: {changes}')
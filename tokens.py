@@ -0,0 +1,164 @@
+from functools import lru_cache
+
+# context length of models, matched by longest prefix
+CONTEXT_LENGTHS = {
+    'gpt-4o': 128000,
+    'gpt-4.1': 1047576,
+    'gpt-4.5': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4-32k': 32768,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'o1': 200000,
+    'o1-mini': 128000,
+    'o3': 200000,
+    'o3-mini': 200000,
+    'o4-mini': 200000,
+    'codellama': 16384,
+    'llama3': 8192,
+    'llama3.1': 128000,
+    'llama3.2': 128000,
+    'llama3.3': 128000,
+    'mistral': 32768,
+}
+DEFAULT_CONTEXT_LENGTH = 2048  # ollama default num_ctx
+OPENAI_CONTEXT_LENGTH = 128000  # of openai models not listed above, current ones have at least that
+MESSAGE_OVERHEAD = 4  # tokens wrapping each message
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few sentences. Keep facts, names, numbers, "
+    "code identifiers and decisions, skip small talk."
+)
+
+
+def context_length(model, default=DEFAULT_CONTEXT_LENGTH):
+    """context length of model, known by name prefix"""
+    name = model.split(':', maxsplit=1)[0]
+    matching = [prefix for prefix in CONTEXT_LENGTHS if name.startswith(prefix)]
+    if not matching:
+        return default
+    return CONTEXT_LENGTHS[max(matching, key=len)]
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """tiktoken encoding of model, imported on first use as it is slow to import"""
+    try:
+        import tiktoken
+    except ModuleNotFoundError:
+        # without tiktoken tokens are estimated from text length
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+@lru_cache(maxsize=16384)
+def count_tokens(text, model):
+    """number of tokens in text, cached so messages are counted only once"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message, model):
+    if not message:
+        return 0
+    return MESSAGE_OVERHEAD + count_tokens(str(message.get('content') or ''), model)
+
+
+def messages_tokens(messages, model):
+    return sum(message_tokens(message, model) for message in messages)
+
+
+def summary_request(summary, messages):
+    """messages asking model for rolling summary of dropped conversation part"""
+    conversation = '\n'.join(f"{message['role']}: {message['content']}" for message in messages)
+    if summary:
+        conversation = f'Summary of earlier part:\n{summary}\n\nContinuation:\n{conversation}'
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": conversation},
+    ]
+
+
+class ContextWindow:
+    """Sliding window of messages that fit into token budget of the model.
+
+    First (system) message and last message are always kept. Older messages that don't
+    fit are dropped, or with summarize=True replaced by rolling summary made by the model.
+    """
+    def __init__(self, model, budget=None, summarize=False, length=None):
+        """length is context length of model, by default known from its name"""
+        self.model = model
+        length = length or context_length(model)
+        self.budget = budget or (length - min(4096, length // 4))  # leave space for the answer
+        self.summarize = summarize
+        self.reset()
+
+    def reset(self):
+        """forget summary, e.g. when conversation is changed"""
+        self.summary = None
+        self.summarized = 0  # number of history messages covered by summary
+        self.selected = 0  # number of history messages sent with last request
+        self.start = 0  # first history message of window, kept while it fits
+
+    def summary_message(self):
+        if not self.summary:
+            return None
+        return {"role": "system", "content": f"Summary of earlier conversation: {self.summary}"}
+
+    def select(self, messages, summarizer=None, stable=True):
+        """messages to send, summarizer(summary, messages) is used to summarize dropped ones
+
+        With stable=True window start stays in place as long as history fits, and when it doesn't,
+        more than needed is dropped. This way requests of many turns start with the same messages,
+        which lets provider reuse cached prompt prefix. Use stable=False when messages are not
+        continuation of previous ones.
+        """
+        system, history = messages[:1], messages[1:]
+        start = self._start(system, history, stable)
+        if self.summarize and summarizer and start > self.summarized:
+            self.summary = summarizer(self.summary, history[self.summarized:start])
+            self.summarized = start
+            start = self._start(system, history, stable)
+        self.selected = len(history) - start
+        if not start:
+            return messages
+        summary = self.summary_message()
+        return system + ([summary] if summary else []) + history[start:]
+
+    def _start(self, system, history, stable=False):
+        """index of first history message that fits into budget"""
+        budget = self.budget - messages_tokens(system, self.model) - message_tokens(self.summary_message(), self.model)
+        if not stable:
+            return self._fit(history, budget)
+        if self.start >= len(history) or messages_tokens(history[self.start:], self.model) > budget:
+            # drop more than needed when window has to move, leaving space for next turns
+            self.start = 0 if self._fit(history, budget) == 0 else self._fit(history, budget * 3 // 4)
+        return self.start
+
+    def _fit(self, history, budget):
+        """index of first history message, so that messages from it fit into budget"""
+        total = 0
+        start = len(history)
+        while start > 0:
+            tokens = message_tokens(history[start-1], self.model)
+            if total + tokens > budget and start < len(history):
+                break
+            total += tokens
+            start -= 1
+        # don't start window with an answer to dropped question
+        while start < len(history) - 1 and history[start].get('role') == 'assistant':
+            start += 1
+        return start
+
+    def describe(self, messages):
+        """prompt tokens of current window against budget"""
+        window = self.select(messages)
+        tokens = messages_tokens(window, self.model)
+        counter = 'tiktoken' if get_encoding(self.model) is not None else 'estimated'
+        summary = f', summary of {self.summarized} messages' if self.summary else ''
+        return f'{tokens}/{self.budget} tokens ({counter}), {self.selected}/{len(messages) - 1} messages in window{summary}'